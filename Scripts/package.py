@@ -3,17 +3,27 @@
 from fnmatch import fnmatch
 from os import path
 import argparse
+import hashlib
+import http.client
 import json
 import os
 import stat
 import re
+import struct
 import subprocess
 import sys
+import tempfile
 import time
 from urllib import request
+from urllib.error import URLError
 import zipfile
 import shutil
 import ntpath
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 # Configuration
 
@@ -22,6 +32,8 @@ import ntpath
 ## Z3_RELEASES_URL = "https://api.github.com/repos/Z3Prover/z3/releases/latest"
 ## Get a specific Z3 release like this:
 Z3_RELEASES_URL = "https://api.github.com/repos/Z3Prover/z3/releases/tags/Z3-4.8.5"
+## How many times do we try to resume an interrupted download?
+DOWNLOAD_ATTEMPTS = 5
 ## How do we extract info from the name of a Z3 release file?
 Z3_RELEASE_REGEXP = re.compile(r"^(?P<directory>z3-[0-9a-z\.]+-(?P<platform>x86|x64)-(?P<os>[a-z0-9\.\-]+)).zip$", re.IGNORECASE)
 
@@ -47,6 +59,15 @@ Z3_INTERESTING_FILES = ["LICENSE.txt", "bin/*"]
 ## On unix systems, which Dafny files should be marked as executable? (Glob syntax; Z3's permissions are preserved)
 UNIX_EXECUTABLES = ["dafny", "dafny-server"]
 
+## Which directories under Source don't affect the build? (Build outputs)
+BUILD_INPUTS_IGNORED = ["bin", "obj", "build", ".gradle", ".vs"]
+## Which files under Source are generated by the build? (Coco's parser, from Dafny.atg and the frame files)
+BUILD_INPUTS_GENERATED = [path.join("Dafny", fname) for fname in ["Parser.cs", "Scanner.cs", "Parser.cs.old", "Scanner.cs.old"]]
+## Where are Coco's frame files?
+COCO_FRAMES_DIRECTORY = path.join("third_party", "Coco", "src")
+## How many builds do we keep in the build cache?
+BUILD_CACHE_ENTRIES = 6
+
 ETCs = ["DafnyPrelude.bpl", "DafnyRuntime.js", "DafnyRuntime.go", "DafnyRuntime.jar", "DafnyRuntime.h"]
 
 # Constants
@@ -57,6 +78,11 @@ SOURCE_DIRECTORY = path.join(ROOT_DIRECTORY, SOURCE_DIRECTORY)
 BINARIES_DIRECTORY = path.join(ROOT_DIRECTORY, BINARIES_DIRECTORY)
 DESTINATION_DIRECTORY = path.join(ROOT_DIRECTORY, DESTINATION_DIRECTORY)
 CACHE_DIRECTORY = path.join(DESTINATION_DIRECTORY, "cache")
+PARTIAL_DIRECTORY = path.join(DESTINATION_DIRECTORY, "partial")
+LOGS_DIRECTORY = path.join(DESTINATION_DIRECTORY, "logs")
+BUILD_CACHE_DIRECTORY = path.join(DESTINATION_DIRECTORY, "build-cache")
+BUILD_DIRECTORY = path.join(DESTINATION_DIRECTORY, "build")
+BUILD_KEY_FILE = ".build-key"
 
 OTHERS = ( [ "Scripts/quicktest.sh" , "Scripts/quicktest.out", "Scripts/allow_on_mac.sh" ] ) ## Other files to include in zip
 OTHER_UPLOADS = ( ["docs/DafnyRef/out/DafnyRef.pdf"] )
@@ -69,9 +95,114 @@ z3ToDotNetOSMapping = {
 }
 
 
+CHUNK_SIZE = 1 << 20
+SPOOL_SIZE = 16 * CHUNK_SIZE # Compressed entries larger than this are kept on disk until they are written
+
+PRINT_LOCK = threading.Lock()
+
 def flush(*args, **kwargs):
-    print(*args, **kwargs)
-    sys.stdout.flush()
+    with PRINT_LOCK:
+        print(*args, **kwargs)
+        sys.stdout.flush()
+
+class BuildError(Exception):
+    pass
+
+class DownloadError(Exception):
+    pass
+
+def sha256_file(fpath):
+    digest = hashlib.sha256()
+    with open(fpath, mode="rb") as reader:
+        for chunk in iter(lambda: reader.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def strip_zip64_extra(extra):
+    """Drop the ZIP64 field (id 1) from a zip entry's extra data; zipfile writes its own if needed."""
+    fields, i = [], 0
+    while i + 4 <= len(extra):
+        field_id, size = struct.unpack("<HH", extra[i:i + 4])
+        if field_id != 1:
+            fields.append(extra[i:i + 4 + size])
+        i += 4 + size
+    return b"".join(fields)
+
+def copy_raw_entry(source, fileinfo, archive, name):
+    """Copy an entry of the zip file `source` into `archive` as `name`, without
+    decompressing and recompressing it.  zipfile has no public API for this,
+    so the local header is written here and the entry is registered with
+    `archive` for its central directory."""
+    with source._lock:
+        source.fp.seek(fileinfo.header_offset)
+        header = source.fp.read(zipfile.sizeFileHeader)
+        if header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile("Bad local header for {}".format(fileinfo.filename))
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        source.fp.seek(name_length + extra_length, os.SEEK_CUR)
+        data_offset = source.fp.tell()
+
+    entry = zipfile.ZipInfo(name, fileinfo.date_time)
+    for attribute in ["compress_type", "comment", "create_system", "create_version", "extract_version",
+                      "flag_bits", "internal_attr", "external_attr", "CRC", "compress_size", "file_size"]:
+        setattr(entry, attribute, getattr(fileinfo, attribute))
+    entry.extra = strip_zip64_extra(fileinfo.extra)
+    entry.flag_bits &= ~0x08 # Sizes and CRC are known, so no data descriptor follows the data
+
+    def chunks():
+        remaining = entry.compress_size
+        while remaining > 0:
+            with source._lock:
+                source.fp.seek(data_offset + entry.compress_size - remaining)
+                chunk = source.fp.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile("Truncated entry {}".format(fileinfo.filename))
+            yield chunk
+            remaining -= len(chunk)
+    write_raw_entry(archive, entry, chunks())
+
+def write_raw_entry(archive, entry, chunks):
+    """Append an entry whose data is already compressed, and whose CRC and sizes
+    are set in `entry`, to `archive`."""
+    zip64 = max(entry.file_size, entry.compress_size) > zipfile.ZIP64_LIMIT
+    with archive._lock:
+        archive.fp.seek(archive.start_dir)
+        entry.header_offset = archive.fp.tell()
+        archive.fp.write(entry.FileHeader(zip64))
+        for chunk in chunks:
+            archive.fp.write(chunk)
+        archive.start_dir = archive.fp.tell()
+        archive.filelist.append(entry)
+        archive.NameToInfo[entry.filename] = entry
+        archive._didModify = True
+
+def compress_file(fpath, level):
+    """Deflate a file (or store it, at level 0) into a temporary file.  Returns
+    (CRC, size, compressed size, temporary file).  zlib releases the GIL, so
+    several files can be compressed at once on threads."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if level else None
+    compressed = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, dir=DESTINATION_DIRECTORY)
+    crc, size = 0, 0
+    with open(fpath, mode="rb") as reader:
+        for chunk in iter(lambda: reader.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            compressed.write(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        compressed.write(compressor.flush())
+    compressed_size = compressed.tell()
+    compressed.seek(0)
+    return crc, size, compressed_size, compressed
+
+def read_checksums(fpath):
+    """Read a file in the format of sha256sum's output: a hash and a file name per line."""
+    checksums = {}
+    with open(fpath) as reader:
+        for line in reader:
+            fields = line.split()
+            if len(fields) == 2:
+                checksums[fields[1].lstrip("*")] = fields[0].lower()
+    return checksums
 
 class Release:
     @staticmethod
@@ -81,70 +212,167 @@ class Release:
             raise Exception("{} does not match Z3_RELEASE_REGEXP".format(name))
         return m.group('platform'), m.group('os'), m.group("directory")
 
-    def __init__(self, js, version, out):
+    def __init__(self, js, version, out, checksums=None):
         self.z3_name = js["name"]
         self.size = js["size"]
         self.url = js["browser_download_url"]
+        ## GitHub reports a "sha256:..." digest for release assets; a checksums file takes precedence
+        digest = js.get("digest") or ""
+        self.sha256 = (checksums or {}).get(self.z3_name) or (digest[len("sha256:"):] if digest.startswith("sha256:") else None)
         self.platform, self.os, self.directory = Release.parse_zip_name(js["name"])
         self.os_name = self.os.split("-")[0]
         self.z3_zip = path.join(CACHE_DIRECTORY, self.z3_name)
+        self.z3_partial = path.join(PARTIAL_DIRECTORY, self.z3_name)
         self.dafny_name = "dafny-{}-{}-{}.zip".format(version, self.platform, self.os)
         if out != None:
             self.dafny_name = out
         self.target = "{}-{}".format(z3ToDotNetOSMapping[self.os_name], self.platform)
         self.dafny_zip = path.join(DESTINATION_DIRECTORY, self.dafny_name)
         self.buildDirectory = path.join(BINARIES_DIRECTORY, self.target, "publish")
+        self.log = path.join(LOGS_DIRECTORY, self.target + ".log")
 
     @property
     def cached(self):
-        return path.exists(self.z3_zip) and path.getsize(self.z3_zip) == self.size
+        return path.exists(self.z3_zip) and path.getsize(self.z3_zip) == self.size and self.verified(self.z3_zip)
 
     @property
     def MB(self):
         return self.size / 1e6
 
+    def verified(self, fpath):
+        return self.sha256 is None or sha256_file(fpath) == self.sha256
+
+    def fetch(self):
+        """Download into the partial file, resuming from where a previous attempt stopped."""
+        offset = path.getsize(self.z3_partial) if path.exists(self.z3_partial) else 0
+        if offset > self.size:
+            offset = 0
+        if offset == self.size:
+            return
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        with request.urlopen(request.Request(self.url, None, headers)) as reader:
+            if reader.status != 206:
+                offset = 0 # The server ignored the Range header
+            with open(self.z3_partial, mode="r+b" if offset else "wb") as writer:
+                writer.seek(offset)
+                writer.truncate()
+                for chunk in iter(lambda: reader.read(CHUNK_SIZE), b""):
+                    writer.write(chunk)
+
     def download(self):
         if self.cached:
-            print("cached!")
-        else:
-            flush("downloading {:.2f}MB...".format(self.MB), end=' ')
-            with request.urlopen(self.url) as reader:
-                with open(self.z3_zip, mode="wb") as writer:
-                    writer.write(reader.read())
-            flush("done!")
+            flush("    + {}: cached!".format(self.z3_name))
+            return
+        flush("    + {}: downloading {:.2f}MB...".format(self.z3_name, self.MB))
+        error = None
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            try:
+                self.fetch()
+                size = path.getsize(self.z3_partial)
+                error = None if size == self.size else "got {} bytes instead of {}".format(size, self.size)
+            except (URLError, OSError, http.client.HTTPException) as e:
+                error = e
+            if error is not None:
+                flush("    + {}: interrupted at {:.2f}MB ({}){}".format(
+                    self.z3_name, (path.getsize(self.z3_partial) if path.exists(self.z3_partial) else 0) / 1e6, error,
+                    ", resuming" if attempt + 1 < DOWNLOAD_ATTEMPTS else ""))
+                continue
+            if not self.verified(self.z3_partial):
+                os.remove(self.z3_partial)
+                error = "checksum mismatch"
+                break
+            os.replace(self.z3_partial, self.z3_zip)
+            flush("    + {}: done!".format(self.z3_name))
+            return
+        raise DownloadError("{}: download failed ({})".format(self.z3_name, error))
 
     @staticmethod
     def zipify_path(fpath):
         """Zip entries always use '/' as the path separator."""
         return fpath.replace(os.path.sep, '/')
 
-    def build(self):
-        os.chdir(ROOT_DIRECTORY)
-        flush("  - Building")
-
+    def publish_commands(self):
+        """Intermediate and output files go to per-target directories outside
+        of Source, so that several targets can be built at the same time.
+        DafnyBuildDirectory is read by Source/Directory.Build.props; OutputPath
+        overrides the Binaries folder that the projects write to."""
+        build = path.join(BUILD_DIRECTORY, self.target)
+        return [["dotnet", "publish", path.join(SOURCE_DIRECTORY, project),
+                 "--nologo",
+                 "-f", "net5.0",
+                 "-o", self.buildDirectory,
+                 "-r", self.target,
+                 "-c", "Checked",
+                 "-p:DafnyBuildDirectory={}".format(build + os.sep),
+                 "-p:OutputPath={}".format(path.join(build, "bin") + os.sep)]
+                for project in [path.join("DafnyServer", "DafnyServer.csproj"), path.join("DafnyDriver", "DafnyDriver.csproj")]]
+
+    def build(self, log):
+        """Publish Dafny for this release's runtime identifier."""
+        if path.exists(self.buildDirectory):
+            shutil.rmtree(self.buildDirectory)
+        for cmd in self.publish_commands():
+            run(cmd, log)
+
+    def lowercase_driver(self):
+        """Rename the Dafny executable to dafny.  Done once per build, before
+        the build is shared by the releases that are packed from it."""
+        uppercaseDafny = path.join(self.buildDirectory, "Dafny")
+        if os.path.exists(uppercaseDafny):
+            lowercaseDafny = path.join(self.buildDirectory, "dafny")
+            shutil.move(uppercaseDafny, lowercaseDafny)
+            os.chmod(lowercaseDafny, stat.S_IEXEC| os.lstat(lowercaseDafny).st_mode)
+
+    def build_key(self, inputs):
+        """Hash of everything that goes into this release's build."""
+        digest = hashlib.sha256(inputs.encode("utf-8"))
+        for cmd in self.publish_commands():
+            digest.update("\0".join(cmd).encode("utf-8"))
+        return digest.hexdigest()
+
+    def build_up_to_date(self, key):
+        stamp = path.join(self.buildDirectory, BUILD_KEY_FILE)
+        if not path.exists(stamp):
+            return False
+        with open(stamp) as reader:
+            return reader.read().strip() == key
+
+    def build_cached(self, key):
+        return self.build_up_to_date(key) or path.isdir(path.join(BUILD_CACHE_DIRECTORY, key))
+
+    def restore_build(self, key):
+        """Reuse the output of an earlier build with the same key, if there is one.
+        Returns a description of where it came from, or None."""
+        if self.build_up_to_date(key):
+            return "already built"
+        cached = path.join(BUILD_CACHE_DIRECTORY, key)
+        if not path.isdir(cached):
+            return None
         if path.exists(self.buildDirectory):
             shutil.rmtree(self.buildDirectory)
-        run(["make", "--quiet", "clean"])
-        run(["make", "--quiet", "runtime"])
-        run(["dotnet", "publish", path.join(SOURCE_DIRECTORY, "DafnyServer", "DafnyServer.csproj"),
-            "--nologo",
-            "-f", "net5.0",
-            "-o", self.buildDirectory,
-            "-r", self.target,
-            "-c", "Checked"])
-        run(["dotnet", "publish", path.join(SOURCE_DIRECTORY, "DafnyDriver", "DafnyDriver.csproj"),
-            "--nologo",
-            "-f", "net5.0",
-            "-o", self.buildDirectory,
-            "-r", self.target,
-            "-c", "Checked"])
-
-    def pack(self):
+        shutil.copytree(cached, self.buildDirectory, symlinks=True)
+        os.utime(cached, None) # Mark as recently used
+        return "restored from the build cache"
+
+    def save_build(self, key):
+        with open(path.join(self.buildDirectory, BUILD_KEY_FILE), mode="w") as writer:
+            writer.write(key)
+        cached = path.join(BUILD_CACHE_DIRECTORY, key)
+        if path.isdir(cached):
+            return
+        tmp = path.join(BUILD_CACHE_DIRECTORY, "." + key)
+        shutil.rmtree(tmp, ignore_errors=True)
+        shutil.copytree(self.buildDirectory, tmp, symlinks=True)
+        os.replace(tmp, cached)
+
+    def pack(self, level=6, jobs=None):
+        """Zip the build and the interesting parts of Z3.  Dafny's files are
+        compressed on `jobs` threads, then written in a fixed order, so the
+        archive is the same whatever the number of jobs."""
         try:
             os.remove(self.dafny_zip)
         except FileNotFoundError:
             pass
-        missing = []
         with zipfile.ZipFile(self.dafny_zip, 'w',  zipfile.ZIP_DEFLATED) as archive:
             with zipfile.ZipFile(self.z3_zip) as Z3_archive:
                 z3_files_count = 0
@@ -152,46 +380,48 @@ class Release:
                     fname = path.relpath(fileinfo.filename, self.directory)
                     if any(fnmatch(fname, pattern) for pattern in Z3_INTERESTING_FILES):
                         z3_files_count += 1
-                        contents = Z3_archive.read(fileinfo)
-                        fileinfo.filename = Release.zipify_path(path.join(DAFNY_PACKAGE_PREFIX, Z3_PACKAGE_PREFIX, fname))
-                        archive.writestr(fileinfo, contents)
-            uppercaseDafny = path.join(self.buildDirectory, "Dafny")
-            if os.path.exists(uppercaseDafny):
-                lowercaseDafny = path.join(self.buildDirectory, "dafny")
-                shutil.move(uppercaseDafny, lowercaseDafny)
-                os.chmod(lowercaseDafny, stat.S_IEXEC| os.lstat(lowercaseDafny).st_mode)
+                        copy_raw_entry(Z3_archive, fileinfo, archive,
+                                       Release.zipify_path(path.join(DAFNY_PACKAGE_PREFIX, Z3_PACKAGE_PREFIX, fname)))
             paths = pathsInDirectory(self.buildDirectory) + list(map(lambda etc: path.join(BINARIES_DIRECTORY, etc), ETCs)) + OTHERS
-            for fpath in paths:
-                if os.path.isdir(fpath):
-                    continue
-                fname = ntpath.basename(fpath)
-                if path.exists(fpath):
+            paths = [fpath for fpath in paths if not os.path.isdir(fpath) and path.basename(fpath) != BUILD_KEY_FILE]
+            missing = [ntpath.basename(fpath) for fpath in paths if not path.exists(fpath)]
+            paths = [fpath for fpath in paths if path.exists(fpath)]
+            jobs = max(1, jobs or os.cpu_count() or 1)
+            with ThreadPoolExecutor(jobs) as executor:
+                # Only compress up to 2 * jobs files ahead of the one being
+                # written, so that memory use doesn't grow with the archive
+                queue = iter(paths)
+                compressed = deque((fpath, executor.submit(compress_file, fpath, level))
+                                   for fpath in islice(queue, 2 * jobs))
+                while compressed:
+                    fpath, future = compressed.popleft()
+                    for following in islice(queue, 1):
+                        compressed.append((following, executor.submit(compress_file, following, level)))
+                    fname = ntpath.basename(fpath)
                     fileinfo = zipfile.ZipInfo(fname, time.localtime(os.stat(fpath).st_mtime)[:6])
                     if self.os_name != 'win':
                         # http://stackoverflow.com/questions/434641/
                         fileinfo.external_attr = 0o100755 << 16
                         fileinfo.create_system = 3  # lie about this zip file's source OS to preserve permissions
-                    contents = open(fpath, mode='rb').read()
-                    fileinfo.compress_type = zipfile.ZIP_DEFLATED
+                    fileinfo.compress_type = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
                     fileinfo.filename = Release.zipify_path(path.join(DAFNY_PACKAGE_PREFIX, fname))
-                    archive.writestr(fileinfo, contents)
-                else:
-                    missing.append(fname)
-        for fpath in OTHER_UPLOADS:
-            shutil.copy(fpath, DESTINATION_DIRECTORY)
-        flush("done! (imported {} files from z3's sources)".format(z3_files_count))
+                    fileinfo.CRC, fileinfo.file_size, fileinfo.compress_size, contents = future.result()
+                    with contents:
+                        write_raw_entry(archive, fileinfo, iter(lambda: contents.read(CHUNK_SIZE), b""))
+        flush("    + {}: done! (imported {} files from z3's sources)".format(self.dafny_name, z3_files_count))
         if missing:
             flush("      WARNING: Not all files were found: {} were missing".format(", ".join(missing)))
 
 def discover(args):
     flush("  - Getting information about latest release")
     options = {"Authorization": "Bearer " + args.github_secret} if args.github_secret else {}
-    req = request.Request(Z3_RELEASES_URL, None, options)
+    checksums = read_checksums(args.z3_checksums) if args.z3_checksums else {}
+    req = request.Request(args.z3_releases_url, None, options)
     with request.urlopen(req) as reader:
         js = json.loads(reader.read().decode("utf-8"))
 
         for release_js in js["assets"]:
-            release = Release(release_js, args.version, args.out)
+            release = Release(release_js, args.version, args.out, checksums)
             if release.platform == "x64":
                 flush("    + Selecting {} ({:.2f}MB, {})".format(release.z3_name, release.MB, release.size))
                 yield release
@@ -203,29 +433,144 @@ def path_leaf(path):
     return tail or ntpath.basename(head)
 
 def pathsInDirectory(directory):
-    return list(map(lambda file: path.join(directory, file), os.listdir(directory)))
+    return list(map(lambda file: path.join(directory, file), sorted(os.listdir(directory))))
 
-def download(releases):
+def download(releases, jobs=None):
     flush("  - Downloading {} z3 archives".format(len(releases)))
-    for release in releases:
-        flush("    + {}:".format(release.z3_name), end=' ')
-        release.download()
+    os.makedirs(PARTIAL_DIRECTORY, exist_ok=True)
+    with ThreadPoolExecutor(max(1, jobs or len(releases))) as executor:
+        futures = [executor.submit(release.download) for release in releases]
+    failed = [future.exception() for future in futures if future.exception() is not None]
+    for error in failed:
+        flush("    + {}".format(error))
+    if failed:
+        sys.exit(1)
 
-def run(cmd):
-    flush("    + {}...".format(" ".join(cmd)), end=' ')
-    retv = subprocess.call(cmd)
+def run(cmd, log=None):
+    """Run cmd, with its output going to the open file `log` if there is one."""
+    if log is None:
+        flush("    + {}...".format(" ".join(cmd)), end=' ')
+    else:
+        log.write("$ {}\n".format(" ".join(cmd)))
+        log.flush()
+    retv = subprocess.call(cmd, stdout=log, stderr=None if log is None else subprocess.STDOUT)
     if retv != 0:
+        if log is not None:
+            raise BuildError("{} failed (see {})".format(" ".join(cmd), log.name))
         flush("failed! (Is Dafny or the Dafny server running?)")
         sys.exit(1)
-    else:
+    elif log is None:
         flush("done!")
 
+def hash_build_inputs():
+    """Hash the sources, project files and runtime sources under SOURCE_DIRECTORY,
+    Coco's frame files, and the .NET SDK version.  The parser that Coco generates
+    is left out: build_shared deletes and regenerates it after the key is computed."""
+    digest = hashlib.sha256()
+    try:
+        digest.update(subprocess.check_output(["dotnet", "--version"]))
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    generated = set(path.join(SOURCE_DIRECTORY, fpath) for fpath in BUILD_INPUTS_GENERATED)
+    for root, dirs, files in os.walk(SOURCE_DIRECTORY):
+        dirs[:] = sorted(d for d in dirs if d not in BUILD_INPUTS_IGNORED)
+        for fname in sorted(files):
+            fpath = path.join(root, fname)
+            if fpath in generated:
+                continue
+            digest.update(Release.zipify_path(path.relpath(fpath, SOURCE_DIRECTORY)).encode("utf-8") + b"\0")
+            digest.update(bytes.fromhex(sha256_file(fpath)))
+    frames = sorted(fname for fname in os.listdir(COCO_FRAMES_DIRECTORY) if fname.endswith(".frame")) \
+        if path.isdir(COCO_FRAMES_DIRECTORY) else []
+    for fname in frames:
+        digest.update(fname.encode("utf-8") + b"\0")
+        digest.update(bytes.fromhex(sha256_file(path.join(COCO_FRAMES_DIRECTORY, fname))))
+    return digest.hexdigest()
+
+def evict_builds(keep):
+    """Delete all but the `keep` most recently used entries of the build cache."""
+    entries = [entry for entry in os.scandir(BUILD_CACHE_DIRECTORY) if entry.is_dir() and not entry.name.startswith(".")]
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[keep:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+def build_shared():
+    """Steps that don't depend on the target platform; run once before the per-platform builds."""
+    os.chdir(ROOT_DIRECTORY)
+    flush("  - Building")
+    run(["make", "--quiet", "clean"])
+    run(["make", "--quiet", "runtime"])
+    # Generate the parser once, rather than in each concurrent build
+    run(["dotnet", "tool", "restore"])
+    run(["make", "--quiet", "-C", path.join(SOURCE_DIRECTORY, "Dafny"), "-f", "Makefile.Linux", "all"])
+
+def build_target(release, key):
+    """Build, or restore from the cache, the publish directory of release.target.
+    All the releases for that target are packed from it."""
+    reused = key and release.restore_build(key)
+    if reused:
+        flush("    + {}: cache hit, {} ({})".format(release.target, reused, key[:12]))
+    else:
+        with open(release.log, mode="w") as log:
+            flush("    + {}: building (log: {})".format(release.target, release.log))
+            start = time.time()
+            release.build(log)
+        if key:
+            release.save_build(key)
+        flush("    + {}: built in {:.0f}s".format(release.target, time.time() - start))
+    release.lowercase_driver()
+
+def pack_releases(releases, builds, args, compression_jobs):
+    """Pack releases that write the same archive (with --out) one after the other."""
+    for release in releases:
+        builds[release.target].result()
+        flush("    + {}: packing".format(release.dafny_name))
+        release.pack(args.compression_level, compression_jobs)
+
 def pack(args, releases):
     flush("  - Packaging {} Dafny archives".format(len(releases)))
+    ## Several Z3 releases (e.g. the Debian and Ubuntu ones) share a .NET
+    ## runtime identifier, and with it a build directory: build each target once
+    targets = {}
     for release in releases:
-        flush("    + {}:".format(release.dafny_name), end=' ')
-        release.build()
-        release.pack()
+        targets.setdefault(release.target, release)
+    archives = {}
+    for release in releases:
+        archives.setdefault(release.dafny_zip, []).append(release)
+    keys = {}
+    if not args.no_build_cache:
+        os.makedirs(BUILD_CACHE_DIRECTORY, exist_ok=True)
+        inputs = hash_build_inputs()
+        keys = {target: release.build_key(inputs) for target, release in targets.items()}
+    runtime_built = all(path.exists(path.join(BINARIES_DIRECTORY, etc)) for etc in ETCs)
+    if keys and runtime_built and all(release.build_cached(keys[target]) for target, release in targets.items()):
+        flush("  - All builds are cached; skipping the shared build steps")
+        os.chdir(ROOT_DIRECTORY)
+    else:
+        build_shared()
+    os.makedirs(LOGS_DIRECTORY, exist_ok=True)
+    jobs = max(1, args.jobs or len(releases))
+    # Share the CPUs between the archives being compressed at the same time
+    compression_jobs = args.compression_jobs or max(1, (os.cpu_count() or 1) // min(jobs, len(archives) or 1))
+    failed = []
+    ## Packers wait for builds, so they get their own threads
+    with ThreadPoolExecutor(jobs) as builder, ThreadPoolExecutor(jobs) as packer:
+        builds = {target: builder.submit(build_target, release, keys.get(target)) for target, release in targets.items()}
+        futures = [(group, packer.submit(pack_releases, group, builds, args, compression_jobs))
+                   for group in archives.values()]
+        for group, future in futures:
+            try:
+                future.result()
+            except BuildError as e:
+                for release in group:
+                    flush("    + {}: failed! {} (Is Dafny or the Dafny server running?)".format(release.dafny_name, e))
+                failed.extend(group)
+    if failed:
+        sys.exit(1)
+    if keys:
+        evict_builds(BUILD_CACHE_ENTRIES)
+    for fpath in OTHER_UPLOADS:
+        shutil.copy(fpath, DESTINATION_DIRECTORY)
     if not args.skip_manual:
         run(["make", "--quiet", "refman-release"])
 
@@ -265,6 +610,17 @@ def parse_arguments():
     parser.add_argument("--trial", help="ignore version.cs discrepancies")
     parser.add_argument("--github_secret", help="access token for making an authenticated GitHub call, to prevent being rate limited.")
     parser.add_argument("--out", help="output zip file")
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="number of platforms to download, build and package at the same time (default: all of them)")
+    parser.add_argument("--compression_level", type=int, default=6, choices=range(10),
+                        help="zlib compression level of Dafny's files in the archives, 0 to store them uncompressed (default: %(default)s)")
+    parser.add_argument("--compression_jobs", type=int, default=None,
+                        help="number of files to compress at the same time for each archive (default: number of CPUs divided by the number of archives built at once)")
+    parser.add_argument("--no_build_cache", action="store_true",
+                        help="always rebuild, instead of reusing builds of identical sources from {}".format(BUILD_CACHE_DIRECTORY))
+    parser.add_argument("--z3_releases_url", default=Z3_RELEASES_URL,
+                        help="GitHub API URL describing the Z3 release to package (default: {})".format(Z3_RELEASES_URL))
+    parser.add_argument("--z3_checksums", help="file of expected SHA-256 hashes of the Z3 archives, in sha256sum format")
     return parser.parse_args()
 
 def main():
@@ -282,7 +638,7 @@ def main():
     releases = list(discover(args))
     if args.os:
         releases = list(filter(lambda release: release.os_name == args.os, releases))
-    download(releases)
+    download(releases, args.jobs)
 
     flush("* Building and packaging Dafny")
     pack(args, releases)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Tests for package.py that don't need dotnet or network access.
+# Run with:  python3 -m unittest test_package   (from the Scripts directory)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from unittest import mock
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+
+import package
+
+PAYLOAD = bytes(range(256)) * (3 * package.CHUNK_SIZE // 256)
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD, honoring Range headers, but drops the connection after
+    `server.drop_after` bytes of each of the first `server.failures` responses."""
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get("Range"))
+        offset = 0
+        if self.headers.get("Range"):
+            offset = int(self.headers["Range"][len("bytes="):].rstrip("-"))
+        body = PAYLOAD[offset:]
+        self.send_response(206 if offset else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            self.wfile.write(body[:self.server.drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        self.server.ranges, self.server.failures, self.server.drop_after = [], 0, package.CHUNK_SIZE + 100
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name, directory in [("CACHE_DIRECTORY", "cache"), ("PARTIAL_DIRECTORY", "partial")]:
+            os.makedirs(path.join(tmp.name, directory))
+            patcher = mock.patch.object(package, name, path.join(tmp.name, directory))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.messages = []
+        patcher = mock.patch.object(package, "flush", self.messages.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def release(self):
+        name = "z3-4.8.5-x64-ubuntu-16.04.zip"
+        js = {"name": name, "size": len(PAYLOAD),
+              "browser_download_url": "http://127.0.0.1:{}/{}".format(self.server.server_port, name),
+              "digest": "sha256:" + hashlib.sha256(PAYLOAD).hexdigest()}
+        return package.Release(js, "3.0.0", None)
+
+    def test_resumes_interrupted_download(self):
+        self.server.failures = 2
+        release = self.release()
+        release.download()
+        with open(release.z3_zip, "rb") as reader:
+            self.assertEqual(reader.read(), PAYLOAD)
+        self.assertFalse(path.exists(release.z3_partial))
+        drop = self.server.drop_after
+        self.assertEqual(self.server.ranges, [None, "bytes={}-".format(drop), "bytes={}-".format(2 * drop)])
+        self.assertEqual(sum("resuming" in message for message in self.messages), 2)
+
+    def test_gives_up_after_last_attempt(self):
+        self.server.failures = package.DOWNLOAD_ATTEMPTS
+        self.server.drop_after = 1000
+        release = self.release()
+        with self.assertRaises(package.DownloadError):
+            release.download()
+        self.assertFalse(path.exists(release.z3_zip))
+        self.assertEqual(len(self.server.ranges), package.DOWNLOAD_ATTEMPTS)
+        interrupted = [message for message in self.messages if "interrupted" in message]
+        self.assertEqual(len(interrupted), package.DOWNLOAD_ATTEMPTS)
+        self.assertTrue(all("resuming" in message for message in interrupted[:-1]))
+        self.assertNotIn("resuming", interrupted[-1])
+
+class BuildKeyTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        for name, directory in [("SOURCE_DIRECTORY", "Source"), ("COCO_FRAMES_DIRECTORY", "frames")]:
+            patcher = mock.patch.object(package, name, path.join(self.root, directory))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.write("Source/Dafny/Dafny.atg", "grammar")
+        self.write("Source/Dafny/Dafny.csproj", "project")
+        self.write("frames/Parser.frame", "parser frame")
+        self.write("frames/Scanner.frame", "scanner frame")
+
+    def write(self, name, contents):
+        fpath = path.join(self.root, name)
+        os.makedirs(path.dirname(fpath), exist_ok=True)
+        with open(fpath, "w") as writer:
+            writer.write(contents)
+
+    def test_key_survives_a_build(self):
+        before = package.hash_build_inputs()
+        # What build_shared does to the tree: make clean, then regenerate the parser
+        self.write("Source/Dafny/Parser.cs", "generated parser")
+        self.write("Source/Dafny/Scanner.cs", "generated scanner")
+        self.write("Source/Dafny/Parser.cs.old", "older parser")
+        self.assertEqual(package.hash_build_inputs(), before)
+        self.assertEqual(package.hash_build_inputs(), package.hash_build_inputs())
+
+    def test_key_covers_the_grammar_and_frames(self):
+        keys = {package.hash_build_inputs()}
+        self.write("Source/Dafny/Dafny.atg", "changed grammar")
+        keys.add(package.hash_build_inputs())
+        self.write("frames/Scanner.frame", "changed scanner frame")
+        keys.add(package.hash_build_inputs())
+        self.assertEqual(len(keys), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Measure the overhead of runTests.py itself: test discovery, pickling, Manager
+IPC and report writing, without Dafny.
+
+Synthetic test trees of the requested sizes are generated (and reused by later
+runs), and runTests.py is pointed at a stub compiler that sleeps for a fixed
+time and prints a fixed amount of output.  For each tree size and number of
+jobs, the benchmark reports:
+
+* startup: time from launching runTests.py to the start of testing;
+* overhead per test: worker time spent on each test beyond the stub's sleep;
+* report: time from the end of testing until runTests.py exits;
+* peak memory of the largest runner process, and of all of them together.
+
+Results are appended to a history file, and compared with the previous
+results for the same configuration to catch runner regressions.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+from time import time, strftime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "Util"))
+from proctree import process_tree_rss
+
+RUNNER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "runTests.py")
+FILES_PER_DIRECTORY = 1000
+METRICS = ["startup", "overhead", "report", "peak_rss", "peak_tree_rss"]
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='Numbers of tests in the generated trees. Default: 1000 10000')
+    parser.add_argument('--jobs', '-j', type=int, nargs='+', default=[1, os.cpu_count() or 1],
+                        help='Values of runTests.py -j to measure. Default: 1 and the number of CPUs')
+    parser.add_argument('--sleep', type=float, default=0.0,
+                        help='Seconds the stub compiler sleeps for each test. Default: 0')
+    parser.add_argument('--output-size', type=int, default=100,
+                        help='Bytes of output the stub compiler prints for each test. Default: 100')
+    parser.add_argument('--run-lines', type=int, default=1,
+                        help='Number of RUN lines calling the stub in each test. Default: 1')
+    parser.add_argument('--workdir', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "Output", "runner-benchmark"),
+                        help='Where to generate trees and run runTests.py. Default: Output/runner-benchmark')
+    parser.add_argument('--history', default='runner-benchmark.jsonl',
+                        help='File to append results to. Default: runner-benchmark.jsonl')
+    parser.add_argument('--label', default=None,
+                        help='Name of this run in the history, e.g. a commit hash')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative slowdown (or memory growth) over the previous run that counts as a regression. Default: 0.2')
+    parser.add_argument('--python', default=sys.executable,
+                        help='Python interpreter used to run runTests.py. Default: this one')
+    return parser.parse_args(args)
+
+def output_contents(size):
+    line = b"Dafny program verifier finished with 1 verified, 0 errors\n"
+    return (line * (size // len(line) + 1))[:max(size - 1, 0)] + b"\n"
+
+def write_stub(workdir, sleep, output_size):
+    """Write the stub compiler and the output it prints; returns its path."""
+    stub_dir = os.path.join(workdir, "stub")
+    os.makedirs(stub_dir, exist_ok=True)
+    payload = os.path.join(stub_dir, "output-{}.txt".format(output_size))
+    with open(payload, mode='wb') as writer:
+        writer.write(output_contents(output_size))
+    stub = os.path.join(stub_dir, "dafny-stub")
+    with open(stub, mode='w') as writer:
+        writer.write("#!/bin/sh\n")
+        if sleep > 0:
+            writer.write("sleep {}\n".format(sleep))
+        writer.write('cat "{}"\n'.format(payload))
+    os.chmod(stub, 0o755)
+    return stub
+
+def generate_tree(workdir, count, output_size, run_lines):
+    """Create `count` tests, FILES_PER_DIRECTORY to a directory, unless a previous run already did."""
+    root = os.path.join(workdir, "tree-{}-{}-{}".format(count, output_size, run_lines))
+    marker = os.path.join(root, ".complete")
+    if os.path.exists(marker):
+        return root
+    shutil.rmtree(root, ignore_errors=True)
+    runs = "".join('// RUN: %dafny "%s" {} "%t"\n'.format(">" if idx == 0 else ">>") for idx in range(run_lines))
+    header = runs + '// RUN: %diff "%s.expect" "%t"\n\n'
+    expected = output_contents(output_size) * run_lines
+    for idx in range(count):
+        directory = os.path.join(root, "d{:04d}".format(idx // FILES_PER_DIRECTORY))
+        if idx % FILES_PER_DIRECTORY == 0:
+            os.makedirs(directory)
+        name = os.path.join(directory, "t{:06d}.dfy".format(idx))
+        with open(name, mode='w') as writer:
+            writer.write(header + "method M{}() {{ }}\n".format(idx))
+        with open(name + ".expect", mode='wb') as writer:
+            writer.write(expected)
+    open(marker, mode='w').close()
+    return root
+
+def run_runner(args, tree, stub, count, njobs):
+    cmd = [args.python, RUNNER, tree, "--compiler", stub, "--base-flags", "", "-j", str(njobs),
+           "--report", os.path.join(args.workdir, "report"), "--verbosity", "1"]
+    start = time()
+    proc = subprocess.Popen(cmd, cwd=args.workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    peak_tree, done = [None], threading.Event()
+    def sample():
+        while not done.wait(0.05):
+            rss = process_tree_rss(proc.pid)
+            if rss is not None:
+                peak_tree[0] = max(peak_tree[0] or 0, rss)
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    started, finished, passed = None, None, 0
+    for line in proc.stderr:
+        if started is None and b"Running" in line:
+            started = time()
+        elif b"Testing complete" in line:
+            finished = time()
+        elif finished is None and b"[PASSED]" in line:
+            passed += 1
+    done.set()
+    sampler.join()
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        peak = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    else:
+        proc.wait()
+        peak = None
+    end = time()
+
+    if started is None or finished is None:
+        raise RuntimeError("runTests.py didn't run the tests: {}".format(" ".join(cmd)))
+    if passed != count:
+        print("WARNING: only {} of {} test(s) passed".format(passed, count))
+    testing = finished - started
+    return {"tests": count, "njobs": njobs, "total": end - start,
+            "startup": started - start, "testing": testing,
+            "overhead": max(0.0, testing * njobs / count - args.sleep * args.run_lines),
+            "report": end - finished, "peak_rss": peak, "peak_tree_rss": peak_tree[0]}
+
+def config_key(result):
+    return (result["tests"], result["njobs"], result["sleep"], result["output_size"], result["run_lines"])
+
+def load_previous(history):
+    """Most recent result for each configuration in the history file."""
+    previous = {}
+    if os.path.exists(history):
+        with open(history) as reader:
+            for line in reader:
+                if line.strip():
+                    result = json.loads(line)
+                    previous[config_key(result)] = result
+    return previous
+
+def fmt_memory(value):
+    return "     n/a" if value is None else "{:6.1f}MB".format(value / 1e6)
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+    if os.name == 'nt':
+        print("The stub compiler is a shell script; run this benchmark on Linux or macOS")
+        return 1
+    os.makedirs(args.workdir, exist_ok=True)
+    stub = write_stub(args.workdir, args.sleep, args.output_size)
+    previous = load_previous(args.history)
+    meta = {"date": strftime("%Y-%m-%d-%H-%M-%S"), "label": args.label, "host": platform.node(),
+            "proc_info": platform.processor(), "python": platform.python_version(),
+            "sleep": args.sleep, "output_size": args.output_size, "run_lines": args.run_lines}
+
+    print("{:>8} {:>4} {:>9} {:>9} {:>12} {:>9} {:>9} {:>9}".format(
+        "tests", "-j", "total", "startup", "overhead", "report", "peak", "all procs"))
+    regressions, results = [], []
+    for count in args.sizes:
+        tree = generate_tree(args.workdir, count, args.output_size, args.run_lines)
+        for njobs in args.jobs:
+            result = dict(meta, **run_runner(args, tree, stub, count, njobs))
+            results.append(result)
+            print("{:>8} {:>4} {:8.2f}s {:8.2f}s {:10.2f}ms {:8.2f}s {} {}".format(
+                count, njobs, result["total"], result["startup"], result["overhead"] * 1000,
+                result["report"], fmt_memory(result["peak_rss"]), fmt_memory(result["peak_tree_rss"])))
+            old = previous.get(config_key(result))
+            if old is not None:
+                for metric in METRICS:
+                    if old.get(metric) and result[metric] is not None and result[metric] > old[metric] * (1 + args.threshold):
+                        regressions.append("{} tests, -j{}: {} went from {:.4g} to {:.4g} (previous run: {})".format(
+                            count, njobs, metric, old[metric], result[metric], old.get("label") or old["date"]))
+
+    with open(args.history, mode='a') as writer:
+        for result in results:
+            writer.write(json.dumps(result) + "\n")
+    print("Results appended to {}".format(args.history))
+
+    if regressions:
+        print("Possible regressions:")
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
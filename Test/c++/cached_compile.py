@@ -0,0 +1,120 @@
+"""Compile a generated C++ test, reusing a cached executable when nothing that
+goes into it has changed.
+
+Usage: python3 cached_compile.py CXX [FLAGS...] -o OUTPUT SOURCE.cpp
+
+Executables are keyed by a hash of the compiler command line, the compiler's
+version, the source file and every header it includes with #include "..."
+(the generated .h, DafnyRuntime.h, ExternDefs.h, ...).  The cache lives in
+$DAFNY_CPP_CACHE (default: .cpp-cache next to this script) and is trimmed to
+$DAFNY_CPP_CACHE_MB megabytes (default: 500), least recently used first.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+CACHE_DIRECTORY = os.environ.get("DAFNY_CPP_CACHE",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cpp-cache"))
+CACHE_LIMIT = float(os.environ.get("DAFNY_CPP_CACHE_MB", "500")) * 1e6
+
+INCLUDE_REGEXP = re.compile(rb'^\s*#\s*include\s*"([^"]+)"', re.MULTILINE)
+
+def parse_command(argv):
+  """Return (output, source, include directories) for a compiler command line."""
+  output, sources, includes = None, [], []
+  args = iter(argv[1:])
+  for arg in args:
+    if arg == "-o":
+      output = next(args)
+    elif arg == "-I":
+      includes.append(next(args))
+    elif arg.startswith("-I"):
+      includes.append(arg[2:])
+    elif arg.endswith(".cpp"):
+      sources.append(arg)
+  return output, sources, includes
+
+def resolve_include(name, directory, includes):
+  for candidate in [directory] + includes:
+    path = os.path.join(candidate, name)
+    if os.path.isfile(path):
+      return os.path.normpath(path)
+  return None
+
+def hash_inputs(argv, sources, includes):
+  digest = hashlib.sha256()
+  digest.update("\0".join(arg for arg in argv if arg not in sources).encode("utf-8"))
+  try:
+    digest.update(subprocess.check_output([argv[0], "--version"], stderr=subprocess.STDOUT))
+  except (OSError, subprocess.CalledProcessError):
+    pass
+
+  seen, pending = set(), [os.path.normpath(source) for source in sources]
+  while pending:
+    path = pending.pop(0)
+    if path in seen:
+      continue
+    seen.add(path)
+    with open(path, "rb") as reader:
+      contents = reader.read()
+    digest.update(os.path.basename(path).encode("utf-8") + b"\0" + hashlib.sha256(contents).digest())
+    for name in INCLUDE_REGEXP.findall(contents):
+      header = resolve_include(name.decode("utf-8"), os.path.dirname(path), includes)
+      if header is not None:
+        pending.append(header)
+  return digest.hexdigest()
+
+def evict(limit):
+  """Delete the least recently used cache entries until the cache fits in `limit` bytes."""
+  entries = []
+  for entry in os.scandir(CACHE_DIRECTORY):
+    if entry.is_file() and not entry.name.startswith("."):
+      info = entry.stat()
+      entries.append((info.st_mtime, info.st_size, entry.path))
+  total = sum(size for _, size, _ in entries)
+  for _, size, path in sorted(entries):
+    if total <= limit:
+      break
+    try:
+      os.remove(path)
+      total -= size
+    except OSError:
+      pass
+
+def copy_executable(source, destination):
+  tmp = destination + ".tmp"
+  shutil.copy2(source, tmp)
+  os.replace(tmp, destination)
+
+def main(argv):
+  output, sources, includes = parse_command(argv)
+  if output is None or not sources:
+    return subprocess.call(argv)
+
+  key = hash_inputs(argv, sources, includes)
+  cached = os.path.join(CACHE_DIRECTORY, key)
+  if os.path.exists(cached):
+    os.utime(cached, None) # Mark as recently used
+    copy_executable(cached, output)
+    print("{}: reused cached executable {}".format(output, key[:12]))
+    return 0
+
+  retv = subprocess.call(argv)
+  if retv == 0 and os.path.exists(output):
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIRECTORY, prefix=".")
+    os.close(fd)
+    shutil.copy2(output, tmp)
+    os.replace(tmp, cached)
+    evict(CACHE_LIMIT)
+  return retv
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
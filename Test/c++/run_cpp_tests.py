@@ -1,8 +1,23 @@
 from __future__ import print_function
 
+import argparse
+import csv
+import json
 import os
+import platform
+import signal
 import sys
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Same columns as runTests.py's reports, so that `runTests.py --compare` can read them
+COLUMNS = ["name", "status", "start", "end", "duration", "returncodes", "suite_time", "njobs",
+           "proc_info", "source_path", "temp_directory", "cmds", "expected", "output",
+           "peak_memory"]
+
+CHUNK_SIZE = 64 * 1024
 
 def in_color(green, text):
   return ("\x1B[01;32m" if green else "\x1B[01;31m") + text + "\x1B[0m"
@@ -13,28 +28,162 @@ def in_red(text):
 def in_green(text):
   return in_color(True, text)
 
-def get_result(test):
-  proc = subprocess.Popen(["./" + test], stdin=subprocess.PIPE,
-      stdout=subprocess.PIPE)
-  out, err = proc.communicate()
-  ret = proc.wait()
+def read_expected(test):
+  """Read the expected output of `test`.  The .dfy.expect files used by lit
+  start with the verifier's summary, which the executable doesn't print."""
+  if os.path.exists(test + ".expect"):
+    with open(test + ".expect", "rb") as f:
+      return f.read()
+  with open(test + ".dfy.expect", "rb") as f:
+    lines = f.read().splitlines(True)
+  while lines and (not lines[0].strip() or lines[0].startswith(b"Dafny program verifier")):
+    lines.pop(0)
+  return b"".join(lines)
+
+def kill_group(proc):
+  try:
+    if os.name == "nt":
+      proc.kill()
+    else:
+      os.killpg(proc.pid, signal.SIGKILL)
+  except OSError:
+    pass # Already gone
+
+def wait_with_usage(proc):
+  """Reap `proc`, returning its exit code and peak resident memory in bytes
+  (None where the platform doesn't report it)."""
+  if not hasattr(os, "wait4"):
+    return proc.wait(), None
+  _, status, usage = os.wait4(proc.pid, 0)
+  proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  return proc.returncode, usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+class Result:
+  def __init__(self, test):
+    self.name = test
+    self.source_path = os.path.abspath(test + ".dfy")
+    self.temp_directory = os.path.dirname(self.source_path)
+    self.cmds = ["./" + test]
+    self.proc_info = platform.processor()
+    self.status = "TestStatus.UNKNOWN"
+    self.label = in_red("ERROR")
+    self.start, self.end, self.duration = None, None, None
+    self.returncodes, self.peak_memory = [], None
+    self.expected, self.output = b"", b""
+    self.suite_time, self.njobs = None, None
+
+  def to_dict(self):
+    row = {col: getattr(self, col) for col in COLUMNS}
+    row["expected"] = self.expected.decode("utf-8", "replace")
+    row["output"] = self.output.decode("utf-8", "replace")
+    return row
+
+def get_result(test, timeout):
+  result = Result(test)
+  try:
+    result.expected = read_expected(test)
+  except IOError:
+    result.label = in_red("NO EXPECT FILE")
+    return result
+
+  result.start = time.time()
+  try:
+    proc = subprocess.Popen(["./" + test], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            start_new_session=(os.name != "nt"))
+  except OSError:
+    result.label = in_red("NOT FOUND")
+    return result
+  proc.stdin.close()
+
+  timed_out = threading.Event()
+  def on_timeout():
+    timed_out.set()
+    kill_group(proc)
+  timer = threading.Timer(timeout, on_timeout)
+  timer.start()
+
+  # Compare the output with the expected output as it arrives
+  chunks, offset, matches = [], 0, True
+  try:
+    while True:
+      chunk = proc.stdout.read1(CHUNK_SIZE) if hasattr(proc.stdout, "read1") else proc.stdout.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      chunks.append(chunk)
+      if matches:
+        matches = result.expected[offset:offset + len(chunk)] == chunk
+        offset += len(chunk)
+    ret, result.peak_memory = wait_with_usage(proc)
+  finally:
+    timer.cancel()
+    kill_group(proc) # Reap any processes the test left behind
+
+  result.end = time.time()
+  result.duration = result.end - result.start
+  result.returncodes = [ret]
+  result.output = b"".join(chunks)
+
+  if timed_out.is_set():
+    result.status, result.label = "TestStatus.TIMEOUT", in_red("TIMEOUT")
+  elif ret != 0:
+    result.status, result.label = "TestStatus.FAILED", in_red("ERROR")
+  elif not matches or offset != len(result.expected):
+    result.status, result.label = "TestStatus.FAILED", in_red("WRONG")
+  else:
+    result.status, result.label = "TestStatus.PASSED", in_green("correct")
+  return result
+
+def run_test(test, timeout):
+  result = get_result(test, timeout)
+  memory = "" if result.peak_memory is None else ", {:.1f}MB".format(result.peak_memory / 1e6)
+  duration = "" if result.duration is None else " [{:.2f}s{}]".format(result.duration, memory)
+  print(test, " ... ", result.label + duration)
+  sys.stdout.flush()
+  return result
 
-  if ret != 0:
-    return in_red("ERROR")
+def write_report(results, name):
+  now = time.strftime("%Y-%m-%d-%H-%M-%S")
+  if name:
+    directory, fname = os.path.split(name)
+    name = os.path.join(directory, now + "--" + fname)
+  else:
+    name = now
 
-  with open(test + ".expect", "rb") as f:
-    expected_out = f.read()
+  rows = [result.to_dict() for result in results]
+  with open(name + ".csv", mode="w", newline="") as writer:
+    csv_writer = csv.DictWriter(writer, COLUMNS, dialect="excel")
+    csv_writer.writeheader()
+    csv_writer.writerows(rows)
+  with open(name + ".json", mode="w") as writer:
+    json.dump(rows, writer, indent=2)
 
-  if out != expected_out:
-    return in_red("WRONG")
-  return in_green("correct")
+def run_tests(tests, njobs=None, timeout=60.0, report=None):
+  njobs = max(1, min(njobs or os.cpu_count() or 1, len(tests) or 1))
+  start = time.time()
+  with ThreadPoolExecutor(njobs) as executor:
+    results = list(executor.map(lambda test: run_test(test, timeout), tests))
+  suite_time = time.time() - start
+  for result in results:
+    result.suite_time, result.njobs = suite_time, njobs
 
-def run_test(test):
-  print(test, " ... ", get_result(test))
+  failed = [result for result in results if result.status != "TestStatus.PASSED"]
+  print("{} of {} test(s) passed in {:.2f}s on {} thread(s)".format(
+      len(results) - len(failed), len(results), suite_time, njobs))
+  if report is not False:
+    write_report(results, report)
+  return 1 if failed else 0
 
-def run_tests(tests):
-  for test in tests:
-    run_test(test)
+def parse_args(args):
+  parser = argparse.ArgumentParser(description="Run compiled C++ backend tests and compare their output with the .expect files.")
+  parser.add_argument("tests", nargs="*", help="Test executables")
+  parser.add_argument("--njobs", "-j", type=int, default=None, help="Number of tests to run in parallel. Default: number of CPUs")
+  parser.add_argument("--timeout", type=float, default=60.0, help="Per-test timeout in seconds. Default: %(default)s")
+  parser.add_argument("--report", "-r", default=None,
+                      help="Base name of the CSV/JSON report. Defaults to the current date and time.")
+  parser.add_argument("--no-report", action="store_true", help="Don't write a report")
+  return parser.parse_args(args)
 
 if __name__ == "__main__":
-  run_tests(sys.argv[1:])
+  args = parse_args(sys.argv[1:])
+  sys.exit(run_tests(args.tests, args.njobs, args.timeout, False if args.no_report else args.report))
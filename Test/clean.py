@@ -4,32 +4,166 @@ This is a convenient script to delete temporary files created by the lit and
 legacy testing infrastructure. Both systems use the same name for Output
 unfortunately so this script needs to be run before switching to the other
 infrastructure.
+
+runTests.py records the scratch directories it creates in a manifest, and so
+does lit when it is run with --param record_scratch=1. When there is a
+manifest, only the paths it lists are deleted, which saves searching the whole
+test tree; use --no-manifest after lit runs that didn't record their paths.
 """
+import argparse
 import logging
 import os
 import shutil
+import stat
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 _name = 'Output'
+_manifest = 'scratch.manifest'
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=__doc__)
+    parser.add_argument('--older-than', type=float, default=None, metavar='DAYS',
+                        help='Only delete scratch paths that were last modified more than DAYS days ago')
+    parser.add_argument('--max-size', type=float, default=None, metavar='MB',
+                        help='Keep the most recent scratch paths, up to a total of MB megabytes')
+    parser.add_argument('--dry-run', '-n', action='store_true',
+                        help='Only show what would be deleted')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='Number of parallel deletions. Default: number of CPUs')
+    parser.add_argument('--no-manifest', action='store_true',
+                        help='Ignore the manifest and only search the tree')
+    return parser.parse_args(args)
+
+def read_manifest(path):
+    with open(path) as reader:
+        return sorted(set(line.strip() for line in reader if line.strip()))
+
+def write_manifest(path, entries):
+    if entries:
+        with open(path, mode='w') as writer:
+            writer.writelines('{}\n'.format(entry) for entry in entries)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def record_scratch_paths(paths, manifest=None):
+    """Add paths that the manifest doesn't list yet to it."""
+    manifest = manifest or os.path.join(os.path.dirname(os.path.abspath(__file__)), _manifest)
+    known = set(read_manifest(manifest)) if os.path.exists(manifest) else set()
+    new = sorted(set(paths) - known)
+    if new:
+        with open(manifest, mode='a') as writer:
+            writer.writelines('{}\n'.format(path) for path in new)
+
+def inside(root, path):
+    """Whether path is root or somewhere under it."""
+    try:
+        root = os.path.realpath(root)
+        return os.path.commonpath([root, os.path.realpath(path)]) == root
+    except ValueError:
+        return False # Different drives
+
+def find_scratch_paths(root):
+    """Search root for Output directories and files, without descending into them."""
+    found = []
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name == _name:
+                found.append(entry.path)
+            elif entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+    return found
+
+def disk_usage(path):
+    """Return (size in bytes, last modification time) of a file or directory tree."""
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        return info.st_size, info.st_mtime
+    size, mtime = 0, info.st_mtime
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                info = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            size += info.st_size
+            mtime = max(mtime, info.st_mtime)
+    return size, mtime
 
-def main():
+def select(paths, older_than, max_size):
+    """Apply the retention options, returning the paths that should be deleted."""
+    if older_than is None and max_size is None:
+        return paths
+    usage = {path: disk_usage(path) for path in paths}
+    selected = set()
+    if older_than is not None:
+        cutoff = time.time() - older_than * 24 * 3600
+        selected.update(path for path in paths if usage[path][1] < cutoff)
+    if max_size is not None:
+        budget = max_size * 1e6
+        for path in sorted(paths, key=lambda p: usage[p][1], reverse=True):
+            if path in selected:
+                continue
+            budget -= usage[path][0]
+            if budget < 0:
+                selected.add(path)
+    return [path for path in paths if path in selected]
+
+def delete(path):
+    """Delete a scratch path, returning it if it's gone and None otherwise."""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            logging.info('Deleting lit temporary directory "{}"'.format(path))
+            shutil.rmtree(path)
+        else:
+            logging.info('Deleting batch testing output file "{}"'.format(path))
+            os.remove(path)
+    except OSError as e:
+        logging.warning('Could not delete "{}": {}'.format(path, e))
+    return None if os.path.lexists(path) else path
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
     logging.basicConfig(level=logging.INFO)
     root = os.path.abspath(os.path.dirname(__file__))
+    manifest = os.path.join(root, _manifest)
     logging.info('Cleaning "{}"'.format(root))
-    count = 0
-
-    for (dirpath, dirnames, filenames) in os.walk(root):
-        rmpath = os.path.join(dirpath, _name)
-        if _name in dirnames:
-            logging.info('Deleting lit temporary directory "{}"'.format(rmpath))
-            shutil.rmtree(rmpath)
-            count += 1
-        elif _name in filenames:
-            logging.info('Deleting batch testing output file "{}"'.format(os.path.join(dirpath, _name)))
-            os.remove(rmpath)
-            count += 1
-
-    logging.info('\n\nDONE: Removed {}'.format(count))
+
+    use_manifest = not args.no_manifest and os.path.exists(manifest)
+    if use_manifest:
+        logging.info('Using manifest "{}"'.format(manifest))
+        recorded = []
+        for path in read_manifest(manifest):
+            if not inside(root, path):
+                logging.warning('Ignoring "{}" from the manifest: it is outside "{}"'.format(path, root))
+            elif os.path.lexists(path):
+                recorded.append(path)
+        paths = list(recorded)
+    else:
+        paths = find_scratch_paths(root)
+
+    targets = select(paths, args.older_than, args.max_size)
+    if args.dry_run:
+        for path in targets:
+            logging.info('Would delete "{}"'.format(path))
+        logging.info('\n\nDONE: Would remove {}'.format(len(targets)))
+        return 0
+
+    with ThreadPoolExecutor(args.jobs or os.cpu_count() or 1) as executor:
+        deleted = set(executor.map(delete, targets)) - {None}
+
+    if use_manifest:
+        write_manifest(manifest, [path for path in recorded if path not in deleted])
+
+    logging.info('\n\nDONE: Removed {}'.format(len(deleted)))
 
 if __name__ == '__main__':
     sys.exit(main())
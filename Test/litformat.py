@@ -0,0 +1,159 @@
+"""
+Custom lit test formats used by lit.site.cfg when lit is run with
+``--param inprocess_diff=1`` on Windows, where ``%diff`` is pydiff, or with
+``--param record_scratch=1``.
+"""
+import io
+import os
+import re
+
+import lit.formats
+import lit.ShUtil
+import lit.Test
+import lit.TestRunner
+
+import clean
+import pydiff
+
+class InProcessDiffShTest(lit.formats.ShTest):
+    """
+    ShTest format that runs the %diff commands at the end of a test inside the
+    lit worker (using pydiff), instead of spawning a diff process for each test.
+    Everything else (preamble commands, substitutions, running the rest of the
+    script) is left to lit's executeShTest. Failures report pydiff's exit code
+    and unified diff output, so this is only meant for platforms where %diff
+    is pydiff anyway.
+    """
+    DBG_PREFIX = re.compile(r"^%dbg\([^)'\"]*\)\s*")
+
+    def __init__(self, diffCommand, **kwargs):
+        super(InProcessDiffShTest, self).__init__(**kwargs)
+        self.diffCommand = diffCommand
+        tokens = self.lex(diffCommand)
+        if tokens is None:
+            raise ValueError("Invalid %diff substitution '{}': not a plain command".format(diffCommand))
+        flags = [token for token in tokens if token.startswith('-')]
+        try:
+            self.defaults = self.parseFlags(flags, (3, False, False))
+        except ValueError as e:
+            raise ValueError("Invalid %diff substitution '{}': {}".format(diffCommand, e))
+        if self.defaults is None:
+            raise ValueError("Invalid %diff substitution '{}': unsupported flags".format(diffCommand))
+
+    @staticmethod
+    def lex(command):
+        try:
+            tokens = list(lit.ShUtil.ShLexer(command, win32Escapes=(os.name == 'nt')).lex())
+        except ValueError:
+            return None
+        if any(not isinstance(token, str) for token in tokens):
+            return None # Redirections, pipes, etc.
+        return tokens
+
+    @staticmethod
+    def parseFlags(flags, defaults):
+        """Return (context, stripTrailingCR, ignoreAllSpace) for a list of diff
+        flags, or None if one of them isn't supported by pydiff. Raises
+        ValueError for a malformed --unified."""
+        context, stripTrailingCR, ignoreAllSpace = defaults
+        for flag in flags:
+            if flag.startswith('--unified='):
+                value = flag[len('--unified='):]
+                if not value.isdigit():
+                    raise ValueError("expected a number of lines in '{}'".format(flag))
+                context = int(value)
+            elif flag == '--strip-trailing-cr':
+                stripTrailingCR = True
+            elif flag in ('-w', '--ignore-all-space'):
+                ignoreAllSpace = True
+            else:
+                return None
+        return context, stripTrailingCR, ignoreAllSpace
+
+    def parseDiff(self, command):
+        """Return (from, to, context, stripTrailingCR, ignoreAllSpace) for a
+        plain %diff command, or None if it has to run in the shell."""
+        command = self.DBG_PREFIX.sub('', command.strip())
+        if not command.startswith(self.diffCommand):
+            return None
+        tokens = self.lex(command[len(self.diffCommand):])
+        if tokens is None:
+            return None
+        files = [token for token in tokens if not token.startswith('-')]
+        try:
+            options = self.parseFlags([token for token in tokens if token.startswith('-')], self.defaults)
+        except ValueError as e:
+            raise ValueError("Invalid diff command '{}': {}".format(command, e))
+        if options is None or len(files) != 2:
+            return None
+        return (files[0], files[1]) + options
+
+    def execute(self, test, litConfig):
+        runShTest = lit.TestRunner._runShTest
+        def runShTestWithInProcessDiffs(test, litConfig, useExternalSh, script, tmpBase):
+            return self.runShTest(runShTest, test, litConfig, useExternalSh, script, tmpBase)
+
+        # Only the last step of executeShTest changes; lit runs one test at a
+        # time in each worker process
+        lit.TestRunner._runShTest = runShTestWithInProcessDiffs
+        try:
+            return super(InProcessDiffShTest, self).execute(test, litConfig)
+        finally:
+            lit.TestRunner._runShTest = runShTest
+
+    def runShTest(self, runShTest, test, litConfig, useExternalSh, script, tmpBase):
+        """Run `script` with lit's `runShTest`, except for its trailing %diff
+        commands, which are run with pydiff once the rest has passed."""
+        script, diffs = list(script), []
+        try:
+            while script:
+                diff = self.parseDiff(script[-1])
+                if diff is None:
+                    break
+                diffs.insert(0, (script.pop(), diff))
+        except ValueError as e:
+            return lit.Test.Result(lit.Test.UNRESOLVED, '{}\n'.format(e))
+        if not script:
+            return runShTest(test, litConfig, useExternalSh, script + [command for command, _ in diffs], tmpBase)
+
+        result = runShTest(test, litConfig, useExternalSh, script, tmpBase)
+        if result.code.isFailure:
+            return result
+
+        execdir = os.path.dirname(test.getExecPath())
+        for command, (fromPath, toPath, context, stripTrailingCR, ignoreAllSpace) in diffs:
+            out = io.StringIO()
+            try:
+                with open(os.path.join(execdir, fromPath), 'rb') as fromFile, \
+                     open(os.path.join(execdir, toPath), 'rb') as toFile:
+                    exitCode = pydiff.diffFiles(fromFile, toFile, context, stripTrailingCR, ignoreAllSpace, out)
+            except (IOError, UnicodeDecodeError) as e:
+                out.write('{}\n'.format(e))
+                exitCode = 2
+            if exitCode != 0:
+                # The log starts with the exit code of the script; report the diff's instead
+                _, _, log = result.output.partition('\n')
+                output = 'Exit Code: {}\n{}\n$ {}\n# command output:\n{}\n# error: command failed with exit status: {}\n'.format(
+                    exitCode, log, self.DBG_PREFIX.sub('', command.strip()), out.getvalue(), exitCode)
+                return lit.Test.Result(lit.Test.FAIL, output)
+        return result
+
+class ScratchRecordingFormat(object):
+    """
+    Wraps another test format, and records the Output directory of each
+    directory of tests in clean.py's manifest when the tests are discovered.
+    """
+    def __init__(self, format):
+        self.format = format
+
+    def getTestsInDirectory(self, testSuite, path_in_suite, litConfig, localConfig):
+        tests = list(self.format.getTestsInDirectory(testSuite, path_in_suite, litConfig, localConfig))
+        if tests:
+            try:
+                clean.record_scratch_paths([os.path.join(testSuite.getExecPath(path_in_suite), 'Output')])
+            except OSError as e:
+                litConfig.warning('Could not update {}: {}'.format(clean._manifest, e))
+        return tests
+
+    def execute(self, test, litConfig):
+        return self.format.execute(test, litConfig)
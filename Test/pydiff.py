@@ -5,9 +5,19 @@ tool. This exists to provide a simple ``diff`` like tool that will run on
 Windows where only the ``fc`` tool is available.
 """
 import argparse
+import bisect
 import difflib
+import io
 import os
 import sys
+from collections import Counter
+
+# Regions without unique lines that are smaller than this (in number of line
+# pairs) are handed to difflib; larger ones are reported as a single change.
+DIFFLIB_REGION_LIMIT = 250000
+
+# Chunk size used when streaming files to check them for equality
+CHUNK_SIZE = 1 << 20
 
 
 def main(args):
@@ -38,60 +48,232 @@ def main(args):
                        )
 
     parsedArgs = parser.parse_args(args)
-    fromFile, fromFileName = preProcess(getattr(parsedArgs,'from-file'),
-                                        parsedArgs.strip_trailing_cr,
-                                        parsedArgs.ignore_all_space
-                                       )
-    toFile, toFileName = preProcess(getattr(parsedArgs,'to-file'),
-                                    parsedArgs.strip_trailing_cr,
-                                    parsedArgs.ignore_all_space
-                                   )
-
-    result = difflib.unified_diff(fromFile,
-                                  toFile,
-                                  fromFileName,
-                                  toFileName,
-                                  n=getattr(parsedArgs,'unified='),
-                                 )
-    # Force lazy computation to happen now
-    result = list(result)
-
-    if len(result) == 0:
-        # Files are identical
+    return diffFiles(getattr(parsedArgs,'from-file'),
+                     getattr(parsedArgs,'to-file'),
+                     getattr(parsedArgs,'unified='),
+                     parsedArgs.strip_trailing_cr,
+                     parsedArgs.ignore_all_space,
+                     sys.stdout
+                    )
+
+def diffFiles(fromFile, toFile, context=3, stripTrailingCR=False, ignoreAllSpace=False, out=sys.stdout):
+    """
+    Compare two files opened in binary mode, writing a unified diff to ``out``.
+    Returns 0 if the files are identical (after normalization) and 1 otherwise.
+    """
+    if not (stripTrailingCR or ignoreAllSpace) and streamEqual(fromFile, toFile):
         return 0
-    else:
-        for l in result:
-            sys.stdout.write(l)
-        return 1
 
-def preProcess(openFile, stripTrailingCR=False, ignoreAllSpace=False):
+    fromContents = normalize(fromFile.read(), stripTrailingCR, ignoreAllSpace)
+    toContents = normalize(toFile.read(), stripTrailingCR, ignoreAllSpace)
+    if fromContents == toContents:
+        return 0
+
+    result = unifiedDiff(splitLines(fromContents),
+                         splitLines(toContents),
+                         fromFile.name,
+                         toFile.name,
+                         n=context,
+                        )
+    for l in result:
+        out.write(l)
+    return 1
+
+def splitLines(contents):
     """
-    Helper function to read lines in a file and do any necessary
-    pre-processing
+    Split raw contents into decoded lines, keeping their terminators. Only
+    ``\\n`` ends a line, as with ``readlines()`` on a binary file; ``str.splitlines``
+    would also split on ``\\r``, form feeds and other Unicode line breaks.
     """
-    original = openFile.readlines()
+    return [line.decode() for line in io.BytesIO(contents).readlines()]
 
-    # Translation table deletes white space characters Note we don't remove
-    # newline characters because this will create a mess when outputting the
-    # diff. Is this the right behaviour?
-    deleteChars=' \t'
-    if sys.version_info.major  >= 3:
-        translationTable = str.maketrans('','', deleteChars)
+def streamEqual(fromFile, toFile):
+    """
+    Check whether two files have the same contents, reading them in chunks.
+    Both files are rewound afterwards.
+    """
+    try:
+        if os.fstat(fromFile.fileno()).st_size != os.fstat(toFile.fileno()).st_size:
+            return False
+    except (AttributeError, OSError):
+        pass # Not a regular file; compare the contents
+
+    try:
+        while True:
+            fromChunk = fromFile.read(CHUNK_SIZE)
+            toChunk = toFile.read(CHUNK_SIZE)
+            if fromChunk != toChunk:
+                return False
+            if not fromChunk:
+                return True
+    finally:
+        fromFile.seek(0)
+        toFile.seek(0)
+
+def normalize(contents, stripTrailingCR=False, ignoreAllSpace=False):
+    """
+    Apply the normalizations requested on the command line to the raw contents
+    of a file.
+    """
+    if stripTrailingCR:
+        contents = contents.replace(b'\r\n', b'\n')
+
+    # Delete white space characters. Note we don't remove newline characters
+    # because this will create a mess when outputting the diff. Is this the
+    # right behaviour?
+    if ignoreAllSpace:
+        contents = contents.translate(None, b' \t')
 
-    copy = [ ]
-    for line in original:
-        newLine = str(line.decode())
+    return contents
 
-        if stripTrailingCR:
-            if newLine[-2:] == '\r\n' or newLine[-2:] == '\n\r':
-                newLine = newLine[:-2] + '\n'
+def unifiedDiff(a, b, fromFileName, toFileName, n=3):
+    """
+    Same output as ``difflib.unified_diff``, but computed with ``PatienceMatcher``.
+    """
+    started = False
+    for group in PatienceMatcher(a, b).get_grouped_opcodes(n):
+        if not started:
+            started = True
+            yield '--- {}\n'.format(fromFileName)
+            yield '+++ {}\n'.format(toFileName)
+
+        first, last = group[0], group[-1]
+        yield '@@ -{} +{} @@\n'.format(formatRange(first[1], last[2]),
+                                       formatRange(first[3], last[4]))
+
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in a[i1:i2]:
+                    yield '-' + line
+            if tag in ('replace', 'insert'):
+                for line in b[j1:j2]:
+                    yield '+' + line
+
+def formatRange(start, stop):
+    """Convert a range to the "ed" format used in hunk headers"""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
+
+class PatienceMatcher(difflib.SequenceMatcher):
+    """
+    A ``SequenceMatcher`` whose matching blocks are computed with the patience
+    diff algorithm: common prefixes and suffixes are skipped, and lines that occur exactly once on both sides are used as
+    anchors (via a longest increasing subsequence). This takes near-linear time
+    on the large, mostly similar outputs that tests produce, whereas difflib
+    can be quadratic.
+    """
+    def __init__(self, a, b):
+        self.a, self.b = a, b
+        self.matching_blocks = None
+        self.opcodes = None
+
+    def get_matching_blocks(self):
+        if self.matching_blocks is not None:
+            return self.matching_blocks
+
+        a, b = self.a, self.b
+        blocks = []
+        regions = [(0, len(a), 0, len(b))]
+        while regions:
+            alo, ahi, blo, bhi = regions.pop()
+            prefix = commonRunLength(a, alo, b, blo, min(ahi - alo, bhi - blo), 1)
+            if prefix:
+                blocks.append((alo, blo, prefix))
+                alo, blo = alo + prefix, blo + prefix
+            suffix = commonRunLength(a, ahi - 1, b, bhi - 1, min(ahi - alo, bhi - blo), -1)
+            if suffix:
+                ahi, bhi = ahi - suffix, bhi - suffix
+                blocks.append((ahi, bhi, suffix))
+            if alo == ahi or blo == bhi:
+                continue
+
+            anchors = uniqueAnchors(a, alo, ahi, b, blo, bhi)
+            if anchors:
+                for i, j in anchors:
+                    if i > alo and j > blo:
+                        regions.append((alo, i, blo, j))
+                    blocks.append((i, j, 1))
+                    alo, blo = i + 1, j + 1
+                regions.append((alo, ahi, blo, bhi))
+            elif (ahi - alo) * (bhi - blo) <= DIFFLIB_REGION_LIMIT:
+                matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+                blocks.extend((alo + i, blo + j, size) for i, j, size in matcher.get_matching_blocks() if size)
+
+        blocks.sort()
+        merged = []
+        for i, j, size in blocks:
+            if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+                merged[-1][2] += size
+            else:
+                merged.append([i, j, size])
+        merged.append([len(a), len(b), 0])
+        self.matching_blocks = [difflib.Match(*block) for block in merged]
+        return self.matching_blocks
+
+def commonRunLength(a, i, b, j, limit, step):
+    """
+    Count how many lines a[i], a[i + step], ... match b[j], b[j + step], ...
+    (up to ``limit``), comparing galloping slices so that long runs of equal
+    lines are checked at C speed.
+    """
+    length, width = 0, 1
+    while width:
+        width = min(width, limit - length)
+        if step > 0:
+            equal = a[i + length:i + length + width] == b[j + length:j + length + width]
+        else:
+            equal = a[i - length - width + 1:i - length + 1] == b[j - length - width + 1:j - length + 1]
+        if equal and width:
+            length += width
+            width *= 2
+        else:
+            width //= 2
+    return length
+
+def uniqueAnchors(a, alo, ahi, b, blo, bhi):
+    """
+    Find the longest increasing sequence of (i, j) pairs such that a[i] == b[j]
+    and that line occurs exactly once in a[alo:ahi] and in b[blo:bhi].
+    """
+    aSlice, bSlice = a[alo:ahi], b[blo:bhi]
+    aCounts, bCounts = Counter(aSlice), Counter(bSlice)
+    bPositions = dict(zip(bSlice, range(blo, bhi)))
+    pairs = [(i, bPositions[line]) for i, line in zip(range(alo, ahi), aSlice)
+             if aCounts[line] == 1 and bCounts.get(line) == 1]
 
-        if ignoreAllSpace:
-            newLine = newLine.translate(translationTable)
+    js = [j for _, j in pairs]
+    if js == sorted(js):
+        return pairs
 
-        copy.append(newLine)
+    # Patience sorting: tails[k] is the index in pairs of the smallest j ending
+    # an increasing subsequence of length k + 1
+    tails, tailJs, backlinks = [], [], []
+    for index, j in enumerate(js):
+        k = bisect.bisect_left(tailJs, j)
+        backlinks.append(tails[k - 1] if k > 0 else None)
+        if k == len(tails):
+            tails.append(index)
+            tailJs.append(j)
+        else:
+            tails[k] = index
+            tailJs[k] = j
 
-    return (copy, openFile.name)
+    anchors = []
+    index = tails[-1] if tails else None
+    while index is not None:
+        anchors.append(pairs[index])
+        index = backlinks[index]
+    anchors.reverse()
+    return anchors
 
 def getFileName(openFile):
     return openFile.name
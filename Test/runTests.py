@@ -4,15 +4,25 @@ import re
 import sys
 import csv
 import shutil
+import copy
+import json
+import uuid
+import signal
 import argparse
 import operator
+import itertools
 import platform
-from math import floor, ceil
+from math import floor, ceil, exp, log
+from statistics import median
 from enum import Enum
 from time import time, strftime
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool, Manager
-from subprocess import Popen, call, PIPE, TimeoutExpired
+from subprocess import Popen, call, PIPE, DEVNULL, TimeoutExpired
+from xml.etree import ElementTree
+
+import clean
 
 # C:/Python34/python.exe runTests.py --compiler "c:/MSR/dafny/Binaries/Dafny.exe" --flags "/useBaseNameForFileName /compile:1 --difftool "C:\Program Files (x86)\Meld\Meld.exe" -j4 --flags "/dprelude preludes\AlmostAllTriggers.bpl" dafny0\SeqFromArray.dfy
 
@@ -21,6 +31,9 @@ from subprocess import Popen, call, PIPE, TimeoutExpired
 VERBOSITY = None
 KILLED = False
 ANSI = False
+PARALLEL_RUN_LINES = True
+RUN_ID = None        # Exported to test commands, to find the processes they leave behind
+LIVE_PROCS = set()   # Test commands running in this worker
 
 try:
     import colorama
@@ -42,6 +55,11 @@ class Defaults:
     COMPILER = [DAFNY_BIN]
     FLAGS = ["/useBaseNameForFileName", "/compile:1", "/timeLimit:300"]
     EXTENSIONS = [".dfy", ".transcript"]
+    # Scratch directories created by test runs, consumed by clean.py
+    SCRATCH_MANIFEST = os.path.join(os.path.dirname(os.path.realpath(__file__)), "scratch.manifest")
+    # %x is replaced by a per-command path for Boogie's XML log, which records per-procedure timings
+    SEED_FLAGS = '/proverOpt:O:smt.random_seed={} /xml:"%x"'
+    RUN_ID_VARIABLE = "DAFNY_RUNTESTS_ID"
 
 class Colors:
     RED = '\033[91m'
@@ -103,26 +121,35 @@ class TestStatus(Enum):
         self.elide = False
 
 class Test:
-    COLUMNS = ["name", "status", "start", "end", "duration", "returncodes", "suite_time", "njobs", "proc_info", "source_path", "temp_directory", "cmds", "expected", "output"]
+    REDIRECT = re.compile(r'^(?P<cmd>.*?)\s*(?P<redirect>>>?)\s*"%t"\s*$')
+    COLUMNS = ["name", "status", "start", "end", "duration", "returncodes", "suite_time", "njobs", "proc_info", "source_path", "temp_directory", "cmds", "expected", "output", "seed", "procedures", "attempts", "first_status", "first_duration", "flaky", "config", "worker"]
 
-    def __init__(self, name, source_path, cmds, timeout, compiler_id = 0):
+    def __init__(self, name, source_path, cmds, timeout, compiler_id = 0, seed = None, config = None, env = None):
         self.name = name
+        self.seed = seed
+        self.config = config
+        self.env = env or {}
         self.source_path = Test.uncygdrive(source_path)
         self.expect_path = Test.source_to_expect_path(self.source_path)
         self.source_directory, self.fname = os.path.split(self.source_path)
         self.temp_directory = os.path.join(self.source_directory, "Output")
-        self.temp_output_path = os.path.join(self.temp_directory, self.fname + ".tmp")
+        # Runs of the same test with different seeds or configurations execute concurrently, so they need separate outputs
+        suffix = "" if config is None else "." + Test.config_file_name(config)
+        suffix += "" if seed is None else ".seed{}".format(seed)
+        self.temp_output_path = os.path.join(self.temp_directory, self.fname + suffix + ".tmp")
+        self.xml_paths = [os.path.join(self.temp_directory, "{}{}.{}.xml".format(self.fname, suffix, idx))
+                          for idx in range(len(cmds))]
 
         self.output = None
         self.expected = Test.read_normalize(self.expect_path)
 
-        self.cmds = cmds
         self.timeout = timeout
         self.compiler_id = compiler_id
-        self.cmds = [cmd.replace("%s", self.source_path) for cmd in self.cmds]
-        self.cmds = [cmd.replace("%S", self.source_directory) for cmd in self.cmds]
-        self.cmds = [cmd.replace("%t", self.temp_output_path) for cmd in self.cmds]
-        self.cmds = [cmd.replace("%T", self.temp_directory) for cmd in self.cmds]
+        self.cmds = [self.expand(cmd, idx) for idx, cmd in enumerate(cmds)]
+        self.schedule = [[(self.expand(cmd, idx), redirect) for idx, cmd, redirect in group]
+                         for group in Test.schedule_cmds(cmds, PARALLEL_RUN_LINES)]
+        self.artifacts = set(Test.artifact_key(cmd) for cmd in self.cmds) - {None}
+        self.exclusive = False  # Set when other copies of this test compile to the same files
 
         self.status = TestStatus.PENDING
         self.proc_info = platform.processor()
@@ -130,6 +157,86 @@ class Test:
         self.time, self.suite_time = None, None
         self.njobs, self.returncodes = None, []
         self.start, self.end, self.duration = None, None, None
+        self.procedures = []
+        self.attempts, self.first_status, self.first_duration, self.flaky = 1, None, None, False
+        self.worker = None
+
+    def prepare_retry(self, timeout):
+        """Return a fresh copy of this test to run again, remembering the outcome of this attempt."""
+        retry = copy.copy(self)
+        retry.first_status, retry.first_duration = self.status, self.duration
+        retry.attempts = self.attempts + 1
+        retry.timeout = timeout
+        retry.status, retry.output = TestStatus.PENDING, None
+        retry.returncodes, retry.procedures = [], []
+        retry.start, retry.end, retry.duration = None, None, None
+        retry.worker = None
+        return retry
+
+    def expand(self, cmd, idx):
+        cmd = cmd.replace("%s", self.source_path)
+        cmd = cmd.replace("%S", self.source_directory)
+        cmd = cmd.replace("%t", self.temp_output_path)
+        cmd = cmd.replace("%T", self.temp_directory)
+        cmd = cmd.replace("%x", self.xml_paths[idx])
+        return cmd
+
+    @staticmethod
+    def artifact_key(cmd):
+        """Return what a RUN line compiles to, or None if it writes no compiled code."""
+        out = re.findall(r'/out:("[^"]*"|\S+)', cmd)
+        if out:
+            return out[-1]
+        compile = re.findall(r'/compile:(\d)', cmd)
+        spill = re.findall(r'/spillTargetCode:(\d)', cmd)
+        if compile and compile[-1] == "0" and not (spill and spill[-1] != "0"):
+            return None
+        targets = re.findall(r'/compileTarget:(\w+)', cmd)
+        return targets[-1] if targets else "cs"
+
+    @staticmethod
+    def schedule_cmds(cmds, parallel):
+        """Split RUN lines into groups of lines that can run concurrently.
+
+        A line joins the current group if it appends its output to %t, reads the
+        test's sources and nothing else, and doesn't compile to the same target as
+        another line of the group.  The output of each line of a group is captured
+        separately and written to %t in the original order.  Each group is a list
+        of (index, command, redirection) triples; redirection is None for lines
+        that are run unchanged."""
+        groups, current, keys = [], [], set()
+
+        def flush():
+            if len(current) == 1:
+                idx, _, _ = current[0]
+                groups.append([(idx, cmds[idx], None)])
+            elif current:
+                groups.append(current)
+
+        for idx, cmd in enumerate(cmds):
+            match = Test.REDIRECT.match(cmd) if parallel else None
+            independent = match is not None and "%s" in match.group("cmd") \
+                          and not re.search(r'%t|%T|/stdin|[|&;<>`]', match.group("cmd"))
+            if independent:
+                body, redirect = match.group("cmd"), match.group("redirect")
+                key = Test.artifact_key(body)
+                if redirect == ">>" and current and (key is None or key not in keys):
+                    current.append((idx, body, redirect))
+                    keys.add(key)
+                    continue
+            flush()
+            if independent:
+                current, keys = [(idx, body, redirect)], {key}
+            else:
+                current, keys = [], set()
+                groups.append([(idx, cmd, None)])
+        flush()
+        return groups
+
+    @staticmethod
+    def config_file_name(config):
+        """The part of output file names that identifies a configuration."""
+        return re.sub(r'[^\w.-]', '_', config)
 
     @staticmethod
     def source_to_expect_path(source):
@@ -148,6 +255,17 @@ class Test:
             debug(Debug.WARNING, "{} not found".format(path))
             return ""
 
+    @staticmethod
+    def record_scratch_paths(tests):
+        """Record the Output directories that this run is about to create, for clean.py."""
+        root = os.path.dirname(Defaults.SCRATCH_MANIFEST)
+        created = [directory for directory in set(test.temp_directory for test in tests)
+                   if not os.path.exists(directory) and clean.inside(root, directory)]
+        try:
+            clean.record_scratch_paths(created, Defaults.SCRATCH_MANIFEST)
+        except OSError as e:
+            debug(Debug.WARNING, "Could not update {}: {}".format(Defaults.SCRATCH_MANIFEST, e))
+
     @staticmethod
     def build_report(tests, name):
         now = strftime("%Y-%m-%d-%H-%M-%S")
@@ -208,11 +326,19 @@ class Test:
 
             debug(Debug.REPORT)
 
+            flaky = [t for t in results if t.flaky]
+            if flaky:
+                debug(Debug.REPORT, "{} test(s) only passed when retried (flaky):".format(len(flaky)))
+                for test in flaky:
+                    debug(Debug.REPORT, "* {} (first attempt: {} after {:.2f}s)".format(
+                        test.name, test.first_status.name, test.first_duration or 0.0))
+                debug(Debug.REPORT)
+
             failing = [t for t in results if t.status != TestStatus.PASSED]
             if failing:
                 with open("failing.lst", mode='w') as writer:
-                    for t in failing:
-                        writer.write("{}\n".format(t.name))
+                    for name in dict.fromkeys(t.name for t in failing): # Once per test, not per seed or configuration
+                        writer.write("{}\n".format(name))
                 debug(Debug.REPORT, "Some tests failed: use [runTests.py failing.lst] to rerun the failing tests")
 
             debug(Debug.REPORT, "Testing took {:.2f}s on {} thread(s){}".format(
@@ -228,24 +354,29 @@ class Test:
         self.start = time()
 
         try:
-            for cmd in self.cmds:
-                debug(Debug.DEBUG, "> {}".format(cmd))
+            for group in self.schedule:
                 try:
-                    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True)
-                    _stdout, _stderr = proc.communicate(timeout=self.timeout)
-                    stdout, stderr = stdout + _stdout, stderr + _stderr
-                    self.returncodes.append(proc.returncode)
-                except FileNotFoundError:
-                    debug(Debug.ERROR, "Program '{}' not found".format(cmd))
+                    results = self.run_group(group)
+                except FileNotFoundError as e:
+                    debug(Debug.ERROR, "Program '{}' not found".format(e.filename))
                     self.status = TestStatus.UNKNOWN
                     return
                 except TimeoutExpired:
                     self.status = TestStatus.TIMEOUT
                     self.end = self.start + self.timeout
                     self.duration = self.timeout
-                    proc.kill()
+                    self.read_procedures(timed_out=True)
                     return
 
+                for (_, redirect), (_stdout, _stderr, returncode) in zip(group, results):
+                    stderr += _stderr
+                    self.returncodes.append(returncode)
+                    if redirect is None:
+                        stdout += _stdout
+                    else:
+                        with open(self.temp_output_path, mode='wb' if redirect == ">" else 'ab') as writer:
+                            writer.write(_stdout)
+
             self.end = time()
             self.duration = self.end - self.start
 
@@ -258,22 +389,102 @@ class Test:
                 debug(Debug.INFO, stderr.decode("utf-8"))
 
             self.update_status()
+            self.read_procedures()
         except TimeoutExpired:
             self.status = TestStatus.TIMEOUT
         except KeyboardInterrupt:
             raise
 
+    def run_cmd(self, cmd, procs):
+        debug(Debug.DEBUG, "> {}".format(cmd))
+        # Each command gets its own process group, so that the shell, Dafny
+        # and the provers it starts can be killed together
+        if os.name == 'nt':
+            group = {"creationflags": 0x00000200} # CREATE_NEW_PROCESS_GROUP
+        else:
+            group = {"start_new_session": True}
+        env = None
+        if RUN_ID or self.env:
+            env = dict(os.environ, **{Defaults.RUN_ID_VARIABLE: RUN_ID} if RUN_ID else {})
+            for variable, value in self.env.items():
+                if value is None:
+                    env.pop(variable, None)
+                else:
+                    env[variable] = value
+        proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True, env=env, **group)
+        procs.append(proc)
+        LIVE_PROCS.add(proc)
+        try:
+            stdout, stderr = proc.communicate(timeout=self.timeout)
+        finally:
+            if os.name != 'nt':
+                kill_tree(proc) # Reap anything the command left running in the background
+            LIVE_PROCS.discard(proc)
+        return stdout, stderr, proc.returncode
+
+    def run_group(self, group):
+        """Run a group of RUN lines concurrently, returning their (stdout, stderr, returncode) in order."""
+        procs = []
+        executor = ThreadPoolExecutor(len(group))
+        try:
+            futures = [executor.submit(self.run_cmd, cmd, procs) for cmd, _ in group]
+            return [future.result() for future in futures]
+        except BaseException: # Timeouts, but also Ctrl-C
+            for proc in procs:
+                kill_tree(proc)
+            raise
+        finally:
+            executor.shutdown()
+
     def update_status(self):
         self.output = Test.read_normalize(self.temp_output_path)
         self.status = TestStatus.PASSED if self.expected == self.output else TestStatus.FAILED
 
+    def read_procedures(self, timed_out=False):
+        """Collect (procedure, duration, outcome, resource count) tuples from Boogie's XML logs, if any.
+        The logs of a test that timed out are cut short: the procedures that
+        completed are read as usual, and the one that was being verified is
+        recorded as "timed out", with the test's duration."""
+        for xml_path in self.xml_paths:
+            if not os.path.exists(xml_path):
+                continue
+            parser = ElementTree.XMLPullParser(events=("start", "end"))
+            try:
+                with open(xml_path, mode='rb') as reader:
+                    parser.feed(reader.read())
+                parser.close()
+            except ElementTree.ParseError as e:
+                if not timed_out:
+                    debug(Debug.WARNING, "Could not parse {}: {}".format(xml_path, e))
+            pending = None
+            for event, element in parser.read_events():
+                if element.tag != "method":
+                    continue
+                if event == "start":
+                    pending = element.get("name")
+                    continue
+                pending = None
+                conclusion = element.find("conclusion")
+                if conclusion is None:
+                    continue
+                rcount = conclusion.get("resourceCount")
+                self.procedures.append((element.get("name"), float(conclusion.get("duration", 0)),
+                                        conclusion.get("outcome"), int(rcount) if rcount else None))
+            if timed_out and pending is not None:
+                self.procedures.append((pending, self.duration, "timed out", None))
+
     def report(self, tid, running, alltests):
         running = [alltests[rid].fname for rid in running]
         running = "; oldest: {}".format(running[0]) if running else ""
 
         fstring = "[{:5.2f}s] {} ({}{})"
         progress = "{}/{}".format(tid, len(alltests))
-        message = fstring.format(self.duration, wrap_color(self.name, Colors.BRIGHT),
+        name = self.name if self.config is None else "{} [{}]".format(self.name, self.config)
+        if self.seed is not None:
+            name += " [seed {}]".format(self.seed)
+        if self.attempts > 1:
+            name += " [attempt {}]".format(self.attempts)
+        message = fstring.format(self.duration, wrap_color(name, Colors.BRIGHT),
                                  wrap_color(progress, Colors.BRIGHT), running)
 
         debug(Debug.INFO, message, headers=self.status)
@@ -331,6 +542,38 @@ def setup_parser():
     parser.add_argument('--timeout', action='store', type=float, default=15*60.0,
                         help='Prover timeout')
 
+    parser.add_argument('--serial-run-lines', action='store_true',
+                        help="Run the RUN lines of each test one after the other, even when they are independent.")
+
+    parser.add_argument('--seeds', action='store', type=int, default=None,
+                        help='Run each test under this many different prover random seeds and report the most brittle tests and procedures.')
+
+    parser.add_argument('--seed-base', action='store', type=int, default=0,
+                        help='First random seed used by --seeds. Default: 0.')
+
+    parser.add_argument('--brittle-top', action='store', type=int, default=20,
+                        help='Number of brittle tests and procedures to list after a --seeds run. Default: 20.')
+
+    parser.add_argument('--matrix', action='store', type=str, default=None,
+                        help='JSON file of named configurations, each with "flags" to add to the command line and "env" variables to set (null unsets). Every test runs under each configuration, and a per-test, per-configuration table is written to matrix.csv.')
+
+    parser.add_argument('--timeline', action='store_true',
+                        help='Report how busy each test worker was, which tests held up the end of the run, and write the schedule to timeline.json (Chrome trace format, for chrome://tracing or Perfetto).')
+    parser.add_argument('--timeline-top', action='store', type=int, default=20,
+                        help='Number of tests on the critical path and of stragglers to list with --timeline. Default: 20.')
+
+    parser.add_argument('--retry', action='store_true',
+                        help='Run tests that timed out again after all the others, with fewer jobs. Tests that pass the second time are reported as flaky.')
+
+    parser.add_argument('--retry-failures', action='store_true',
+                        help='With --retry, also retry tests that failed.')
+
+    parser.add_argument('--retry-njobs', action='store', type=int, default=None,
+                        help='Number of test workers for retries. Default: a quarter of --njobs.')
+
+    parser.add_argument('--retry-timeout', action='store', type=float, default=None,
+                        help='Prover timeout for retries. Default: --timeout.')
+
     parser.add_argument('--compare', action='store_true',
                         help="Compare two previously generated reports.")
 
@@ -351,14 +594,110 @@ def setup_parser():
 
     return parser
 
-def run_one_internal(test, test_id, args, running):
+def kill_tree(proc):
+    """Kill a test command along with every process it started."""
+    try:
+        if os.name == 'nt':
+            if proc.poll() is None:
+                call(["taskkill", "/F", "/T", "/PID", str(proc.pid)], stdout=DEVNULL, stderr=DEVNULL)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass # Already gone
+
+def init_worker():
+    """Leave Ctrl-C to the main process, which terminates the pool: a worker
+    interrupted while holding the pool's queue lock would deadlock it.  Test
+    commands are in their own process groups, so workers kill them when
+    terminated, or they would outlive the run."""
+    if os.name == 'nt':
+        return # Workers are killed outright; they handle Ctrl-C in run_group instead
+    def terminate(signum, frame):
+        for proc in list(LIVE_PROCS):
+            kill_tree(proc)
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, terminate)
+
+def find_leftover_processes(run_id):
+    """Return (pid, command line) of the processes that still have this run's
+    ID in their environment.  Needs /proc, so this only finds anything on Linux."""
+    marker = "{}={}".format(Defaults.RUN_ID_VARIABLE, run_id).encode("utf-8")
+    leftovers = []
+    if not os.path.isdir("/proc"):
+        return leftovers
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/environ".format(entry), mode='rb') as reader:
+                if marker not in reader.read().split(b"\0"):
+                    continue
+            with open("/proc/{}/cmdline".format(entry), mode='rb') as reader:
+                cmdline = reader.read().replace(b"\0", b" ").decode("utf-8", "replace").strip()
+            leftovers.append((int(entry), cmdline))
+        except OSError:
+            continue
+    return leftovers
+
+def kill_leftover_processes(run_id):
+    leftovers = find_leftover_processes(run_id)
+    if leftovers:
+        debug(Debug.WARNING, "Killing {} process(es) left behind by the tests:".format(len(leftovers)))
+    for pid, cmdline in leftovers:
+        debug(Debug.WARNING, "  [{}] {}".format(pid, cmdline[:200]))
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def separate_compiling_copies(tests):
+    """Copies of a test (one per seed or configuration) that compile write the
+    same files next to the source, so they mustn't run at the same time: mark
+    them as exclusive, and move the n-th copy of each such test after all the
+    (n-1)-th copies, so that workers seldom have to wait for each other."""
+    copies = defaultdict(list)
+    for t in tests:
+        copies[t.source_path].append(t)
+    rank = {}
+    for group in copies.values():
+        artifacts = [artifact for t in group for artifact in t.artifacts]
+        if len(artifacts) > len(set(artifacts)):
+            for idx, t in enumerate(group):
+                t.exclusive = True
+                rank[id(t)] = idx
+    return [t for _, t in sorted(enumerate(tests), key=lambda pair: (rank.get(id(pair[1]), 0), pair[0]))]
+
+def acquire_source(test, exclusive):
+    """Wait until no other copy of `test` is running, then claim its source."""
+    busy, condition = exclusive
+    with condition:
+        while test.source_path in busy:
+            condition.wait()
+        busy[test.source_path] = True
+
+def release_source(test, exclusive):
+    busy, condition = exclusive
+    with condition:
+        busy.pop(test.source_path, None)
+        condition.notify_all()
+
+def run_one_internal(test, test_id, args, running, exclusive):
     global KILLED
     global VERBOSITY
+    global RUN_ID
     VERBOSITY = args.verbosity
+    RUN_ID = args.run_id
 
     if not KILLED:
+        claimed = False
         try:
+            if test.exclusive:
+                acquire_source(test, exclusive)
+                claimed = True
             running.append(test_id)
+            test.worker = os.getpid()
             test.run()
         except KeyboardInterrupt:
             # There's no reliable way to handle this cleanly on Windows: if one
@@ -369,7 +708,10 @@ def run_one_internal(test, test_id, args, running):
             debug(Debug.ERROR, "[{}] {}".format(test.name, e))
             test.status = TestStatus.UNKNOWN
         finally:
-            running.remove(test_id)
+            if test_id in running:
+                running.remove(test_id)
+            if claimed:
+                release_source(test, exclusive)
 
     return test
 
@@ -385,35 +727,82 @@ def get_server_path(compiler):
 
 def substitute_binaries(cmd, compiler):
     cmd = cmd.replace("%dafny", compiler)
-    cmd = cmd.replace("%server", get_server_path(compiler))
+    server = get_server_path(compiler)
+    if server is not None:
+        cmd = cmd.replace("%server", server)
     return cmd
 
-def read_one_test(fname, compiler_cmds, timeout):
+def read_matrix(path):
+    """Read a configuration matrix: a JSON object mapping each configuration's
+    name to its "flags" (a string or a list) and "env" (variable -> value).
+    Returns a list of (name, flags, env) triples, in the order of the file."""
+    with open(path) as reader:
+        matrix = json.load(reader)
+    if not isinstance(matrix, dict) or not matrix:
+        raise ValueError("expected a non-empty object mapping configuration names to configurations")
+    configs, file_names = [], {}
+    for name, config in matrix.items():
+        # Configurations run concurrently and write to files named after them; case-insensitive file systems included
+        file_name = Test.config_file_name(name).lower()
+        if file_name in file_names:
+            raise ValueError("configurations {} and {} would share output files; rename one of them".format(file_names[file_name], name))
+        file_names[file_name] = name
+        unknown = set(config) - {"flags", "env"}
+        if unknown:
+            raise ValueError("unknown key(s) {} in configuration {}".format(", ".join(sorted(unknown)), name))
+        flags = config.get("flags", "")
+        if not isinstance(flags, str):
+            flags = " ".join(flags)
+        env = {variable: None if value is None else str(value) for variable, value in config.get("env", {}).items()}
+        configs.append((name, flags, env))
+    return configs
+
+def interleave_configs(tests):
+    """Rotate the order of each test's configurations from one test to the
+    next, so that no configuration always starts first (or last) and each one
+    runs on an equally busy machine.  `tests` must be sorted by name.  The
+    configurations of tests that compile can't run side by side after all;
+    separate_compiling_copies spreads those out again."""
+    interleaved, offset = [], 0
+    for _, runs in itertools.groupby(tests, key=operator.attrgetter("name")):
+        runs = list(runs)
+        configs = sorted(set(t.config for t in runs), key=[t.config for t in runs].index)
+        rotated = configs[offset % len(configs):] + configs[:offset % len(configs)]
+        interleaved.extend(sorted(runs, key=lambda t: rotated.index(t.config)))
+        offset += 1
+    return interleaved
+
+def read_one_test(fname, compiler_cmds, timeout, seeds, configs=((None, "", {}),)):
     for cid, compiler_cmd in enumerate(compiler_cmds):
-        source_path = os.path.realpath(fname)
-        with open(source_path, mode='r') as reader:
-            cmds = []
-            for line in reader:
-                line = line.strip()
-                match = re.match("^[/# ]*RUN: *(?!%diff)([^ ].*)$", line)
-                if match:
-                    debug(Debug.TRACE, "Found RUN spec: {}".format(line))
-                    cmds.append(substitute_binaries(match.groups()[0], compiler_cmd))
-                else:
-                    break
-        if cmds:
-            yield Test(fname, source_path, cmds, timeout, cid)
-        else:
-            debug(Debug.WARNING, "Test file {} has no RUN specification".format(fname))
+        for (config, flags, env), seed in itertools.product(configs, seeds):
+            compiler_cmd_seeded = compiler_cmd + " " + flags if flags else compiler_cmd
+            if seed is not None:
+                compiler_cmd_seeded += " " + Defaults.SEED_FLAGS.format(seed)
+            source_path = os.path.realpath(fname)
+            with open(source_path, mode='r') as reader:
+                cmds = []
+                for line in reader:
+                    line = line.strip()
+                    match = re.match("^[/# ]*RUN: *(?!%diff)([^ ].*)$", line)
+                    if match:
+                        debug(Debug.TRACE, "Found RUN spec: {}".format(line))
+                        cmds.append(substitute_binaries(match.groups()[0], compiler_cmd_seeded))
+                    else:
+                        break
+            if cmds:
+                yield Test(fname, source_path, cmds, timeout, cid, seed, config, env)
+            else:
+                debug(Debug.WARNING, "Test file {} has no RUN specification".format(fname))
+                return
 
 
-def find_one(fname, compiler_cmds, timeout):
+def find_one(fname, compiler_cmds, timeout, seeds, configs):
     _, name = os.path.split(fname)
     _, ext = os.path.splitext(name)
     if ext in Defaults.EXTENSIONS and not any(re.search(pattern, name, re.IGNORECASE) for pattern in Defaults.EXCLUDED_FILES):
         if os.path.exists(fname):
             debug(Debug.TRACE, "Found test file: {}".format(fname))
-            yield from read_one_test(fname, compiler_cmds, timeout)
+            yield from read_one_test(fname, compiler_cmds, timeout, seeds, configs)
         else:
             debug(Debug.ERROR, "Test file {} not found".format(fname))
     else:
@@ -432,16 +821,16 @@ def expand_lsts(paths):
         else:
             yield path
 
-def find_tests(paths, compiler_cmds, excluded, timeout):
+def find_tests(paths, compiler_cmds, excluded, timeout, seeds=(None,), configs=((None, "", {}),)):
     for path in expand_lsts(paths):
         if os.path.isdir(path):
             debug(Debug.TRACE, "Searching for tests in {}".format(path))
             for base, dirnames, fnames in os.walk(path):
                 dirnames[:] = [d for d in dirnames if d not in excluded]
                 for fname in fnames:
-                    yield from find_one(os.path.join(base, fname), compiler_cmds, timeout)
+                    yield from find_one(os.path.join(base, fname), compiler_cmds, timeout, seeds, configs)
         else:
-            yield from find_one(path, compiler_cmds, timeout)
+            yield from find_one(path, compiler_cmds, timeout, seeds, configs)
 
 def run_tests(args):
     if args.compiler is None:
@@ -454,30 +843,51 @@ def run_tests(args):
         if not os.path.exists(compiler):
             debug(Debug.ERROR, "Compiler not found: {}".format(compiler))
             return
-        if not os.path.exists(server):
+        if server is None or not os.path.exists(server):
             debug(Debug.WARNING, "Server not found")
 
+    configs = ((None, "", {}),)
+    if args.matrix is not None:
+        try:
+            configs = read_matrix(args.matrix)
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            debug(Debug.ERROR, "Invalid configuration matrix {}: {}".format(args.matrix, e))
+            return
+
+    seeds = (None,) if args.seeds is None else range(args.seed_base, args.seed_base + args.seeds)
     tests = list(find_tests(args.path, [compiler + ' ' + " ".join(args.base_flags + args.flags)
                                         for compiler in args.compiler],
-                            args.exclude + Defaults.EXCLUDED_FOLDERS, args.timeout))
+                            args.exclude + Defaults.EXCLUDED_FOLDERS, args.timeout, seeds, configs))
     tests.sort(key=operator.attrgetter("name"))
+    if args.matrix is not None:
+        tests = interleave_configs(tests)
+    if args.seeds is not None or args.matrix is not None:
+        tests = separate_compiling_copies(tests)
 
     args.njobs = max(1, min(args.njobs or os.cpu_count() or 1, len(tests)))
     debug(Debug.INFO, "\nRunning {} test(s) on {} testing thread(s), timeout is {:.2f}s, started at {}".format(len(tests), args.njobs, args.timeout, strftime("%H:%M:%S")))
+    Test.record_scratch_paths(tests)
 
+    args.run_id = uuid.uuid4().hex
     try:
-        pool = Pool(args.njobs)
-
-        results = []
         start = time()
-        with Manager() as manager:
-            running = manager.list()
-            payloads = [(t, tid, args, running) for (tid, t) in enumerate(tests)]
-            for tid, test in enumerate(pool.imap_unordered(run_one, payloads, 1)):
-                test.report(tid + 1, running, tests)
-                results.append(test)
-            pool.close()
-            pool.join()
+        results = run_pass(tests, args.njobs, args)
+        passes = [("main pass", args.njobs, start, time(), results)]
+
+        retry_statuses = [TestStatus.TIMEOUT] + ([TestStatus.FAILED, TestStatus.UNKNOWN] if args.retry_failures else [])
+        retries = [t.prepare_retry(args.retry_timeout or args.timeout)
+                   for t in results if args.retry and t.status in retry_statuses]
+        if retries:
+            njobs = max(1, min(args.retry_njobs or args.njobs // 4, len(retries)))
+            debug(Debug.INFO, "\nRetrying {} test(s) on {} testing thread(s), timeout is {:.2f}s".format(
+                len(retries), njobs, retries[0].timeout))
+            retry_start = time()
+            retried = run_pass(retries, njobs, args)
+            passes.append(("retries", njobs, retry_start, time(), retried))
+            for t in retried:
+                t.flaky = t.status == TestStatus.PASSED
+            by_key = {(t.name, t.compiler_id, t.seed, t.config): t for t in retried}
+            results = [by_key.get((t.name, t.compiler_id, t.seed, t.config), t) for t in results]
         suite_time = time() - start
 
         for t in results:
@@ -486,13 +896,39 @@ def run_tests(args):
 
         Test.summarize(results)
         Test.build_report(results, args.report)
+        if args.seeds is not None:
+            report_brittleness(results, args.brittle_top)
+        if args.matrix is not None:
+            report_matrix(results, [name for name, _, _ in configs])
+        if args.timeline:
+            report_timeline(passes, args.timeline_top)
+    except KeyboardInterrupt:
+        debug(Debug.ERROR, "Testing interrupted")
+    finally:
+        kill_leftover_processes(args.run_id)
+
+def run_pass(tests, njobs, args):
+    """Run tests on a pool of `njobs` workers, reporting each one as it completes."""
+    pool = Pool(njobs, initializer=init_worker)
+    try:
+        results = []
+        with Manager() as manager:
+            running = manager.list()
+            exclusive = (manager.dict(), manager.Condition())
+            payloads = [(t, tid, args, running, exclusive) for (tid, t) in enumerate(tests)]
+            for tid, test in enumerate(pool.imap_unordered(run_one, payloads, 1)):
+                test.report(tid + 1, running, tests)
+                results.append(test)
+            pool.close()
+            pool.join()
+        return results
     except KeyboardInterrupt:
         try:
             pool.terminate()
             pool.join()
         except (FileNotFoundError, EOFError, ConnectionAbortedError):
             pass
-        debug(Debug.ERROR, "Testing interrupted")
+        raise
 
 
 def diff(paths, force_accept, difftool):
@@ -547,11 +983,198 @@ def compare_results(globs, time_all):
 
             csv_writer.writerow(row)
 
+def spread_stats(values):
+    """Return (min, median, max, relative spread) of a non-empty list of numbers."""
+    lo, mid, hi = min(values), median(values), max(values)
+    return lo, mid, hi, (hi - lo) / mid if mid else 0.0
+
+def report_brittleness(results, top):
+    """Rank tests and procedures by failure rate, then by the spread of their
+    timings (or resource counts, when Boogie reports them) across seeds."""
+    per_test = defaultdict(list)
+    per_proc = defaultdict(list)
+    for test in results:
+        per_test[test.name].append(test)
+        for proc, duration, outcome, rcount in test.procedures:
+            per_proc[(test.name, proc)].append((duration, outcome, rcount))
+
+    test_rows = []
+    for name, runs in per_test.items():
+        failures = sum(1 for t in runs if t.status != TestStatus.PASSED)
+        durations = [t.duration for t in runs if t.duration is not None]
+        if durations:
+            test_rows.append((name, "", len(runs), failures / len(runs)) + spread_stats(durations) + ("time",))
+
+    proc_rows = []
+    for (name, proc), runs in per_proc.items():
+        failures = sum(1 for _, outcome, _ in runs if outcome != "correct")
+        rcounts = [rcount for _, _, rcount in runs if rcount is not None]
+        if len(rcounts) == len(runs):
+            stats, metric = spread_stats(rcounts), "rcount"
+        else:
+            stats, metric = spread_stats([duration for duration, _, _ in runs]), "time"
+        proc_rows.append((name, proc, len(runs), failures / len(runs)) + stats + (metric,))
+
+    rank = lambda row: (row[3], row[7])
+    test_rows.sort(key=rank, reverse=True)
+    proc_rows.sort(key=rank, reverse=True)
+
+    fstring = "{:6.1%} failed, {} spread {:7.1%} ({:.2f} .. {:.2f}): {}"
+    debug(Debug.REPORT, "Most brittle tests:")
+    for name, _, _, rate, lo, _, hi, spread, metric in test_rows[:top]:
+        debug(Debug.REPORT, "  " + fstring.format(rate, metric, spread, lo, hi, name))
+    if proc_rows:
+        debug(Debug.REPORT, "Most brittle procedures:")
+        for name, proc, _, rate, lo, _, hi, spread, metric in proc_rows[:top]:
+            debug(Debug.REPORT, "  " + fstring.format(rate, metric, spread, lo, hi, "{} ({})".format(proc, name)))
+
+    with open("brittleness.csv", mode='w', newline='') as writer:
+        csv_writer = csv.writer(writer, dialect='excel')
+        csv_writer.writerow(["Name", "Procedure", "Runs", "FailureRate", "Min", "Median", "Max", "Spread", "Metric"])
+        csv_writer.writerows(test_rows)
+        csv_writer.writerows(proc_rows)
+    debug(Debug.REPORT, "Brittleness report written to brittleness.csv")
+
+def geometric_mean(values):
+    return exp(sum(log(v) for v in values) / len(values))
+
+def report_matrix(results, configs):
+    """Tabulate the median duration and the status of each test under each
+    configuration, relative to the first one, and summarize each configuration
+    over the tests that passed under all of them."""
+    runs = defaultdict(list)
+    for test in results:
+        runs[(test.name, test.compiler_id, test.config)].append(test)
+    names = sorted(set((name, cid) for name, cid, _ in runs))
+    multiple_compilers = len(set(cid for _, cid in names)) > 1
+
+    def cell(key):
+        tests = runs.get(key, [])
+        failing = [t for t in tests if t.status != TestStatus.PASSED]
+        durations = [t.duration for t in tests if t.duration is not None]
+        status = failing[0].status if failing else TestStatus.PASSED if tests else TestStatus.UNKNOWN
+        return status, median(durations) if durations else None
+
+    table = {(name, cid): [cell((name, cid, config)) for config in configs] for name, cid in names}
+    common = [key for key, cells in table.items()
+              if all(status == TestStatus.PASSED and duration for status, duration in cells)]
+
+    debug(Debug.REPORT, "Configurations ({} of {} test(s) passed under all of them):".format(len(common), len(names)))
+    for idx, config in enumerate(configs):
+        passed = sum(1 for cells in table.values() if cells[idx][0] == TestStatus.PASSED)
+        total = sum(table[key][idx][1] for key in common)
+        message = "  {}: {} passed, {:.2f}s".format(config, passed, total)
+        if idx > 0 and common:
+            ratios = [table[key][idx][1] / table[key][0][1] for key in common]
+            faster = sum(1 for r in ratios if r < 0.9)
+            slower = sum(1 for r in ratios if r > 1.1)
+            message += " ({:+.1%} per test vs {}; {} faster, {} slower by 10%+)".format(
+                geometric_mean(ratios) - 1, configs[0], faster, slower)
+        debug(Debug.REPORT, message)
+
+    with open("matrix.csv", mode='w', newline='') as writer:
+        csv_writer = csv.writer(writer, dialect='excel')
+        header = ["Name"]
+        for idx, config in enumerate(configs):
+            header += [config + " status", config + " time"] + ([config + " vs " + configs[0]] if idx > 0 else [])
+        csv_writer.writerow(header)
+        for name, cid in names:
+            cells = table[(name, cid)]
+            row = [name if not multiple_compilers else "{} [compiler {}]".format(name, cid)]
+            for idx, (status, duration) in enumerate(cells):
+                row += [status.name, "" if duration is None else "{:.3f}".format(duration)]
+                if idx > 0:
+                    reference = cells[0]
+                    comparable = status == reference[0] == TestStatus.PASSED and duration and reference[1]
+                    row.append("{:+.2%}".format(duration / reference[1] - 1) if comparable else "")
+            csv_writer.writerow(row)
+        sums = [sum(table[key][idx][1] for key in common) for idx in range(len(configs))]
+        totals = ["$$TOTAL$$"]
+        for idx, total in enumerate(sums):
+            totals += ["", "{:.3f}".format(total)]
+            if idx > 0:
+                totals.append("{:+.2%}".format(total / sums[0] - 1) if sums[0] else "")
+        csv_writer.writerow(totals)
+    debug(Debug.REPORT, "Per-test table written to matrix.csv")
+
+def timeline_name(test):
+    name = test.name if test.config is None else "{} [{}]".format(test.name, test.config)
+    return name if test.seed is None else "{} [seed {}]".format(name, test.seed)
+
+def schedule_slots(tests):
+    """Group tests by the worker that ran them, numbering workers by when they started."""
+    by_worker = defaultdict(list)
+    for test in tests:
+        if test.start is not None and test.end is not None:
+            by_worker[test.worker].append(test)
+    slots = sorted(by_worker.values(), key=lambda runs: min(t.start for t in runs))
+    return [sorted(runs, key=operator.attrgetter("start")) for runs in slots]
+
+def report_timeline(passes, top):
+    """Summarize how the tests of each pass were spread over the workers, and
+    write the whole schedule to timeline.json in Chrome's trace event format.
+
+    Once the last test has started, workers that run out of tests stay idle
+    until the end of the pass: this idle tail, and the tests still running
+    during it, are what a better order or -j would reduce.  The critical path
+    is the sequence of tests run by the worker that finished last."""
+    events = []
+    for pid, (label, njobs, start, end, tests) in enumerate(passes):
+        slots = schedule_slots(tests)
+        wall = end - start
+        if not slots or wall <= 0:
+            continue
+        runs = [t for slot in slots for t in slot]
+        busy = sum(t.end - t.start for t in runs)
+        capacity = njobs * wall
+        drained = max(t.start for t in runs)
+        longest = max(runs, key=lambda t: t.end - t.start)
+        tails = [end - slot[-1].end for slot in slots] + [wall] * (njobs - len(slots))
+
+        debug(Debug.REPORT, "Timeline of the {} ({} test(s), {} worker(s), {:.2f}s):".format(label, len(runs), njobs, wall))
+        debug(Debug.REPORT, "  Worker capacity used: {:.1%} ({:.2f}s busy out of {:.2f}s)".format(busy / capacity, busy, capacity))
+        debug(Debug.REPORT, "  Last test started at {:.2f}s; idle tail: {:.2f}s of worker time ({:.1%} of capacity)".format(
+            drained - start, sum(tails), sum(tails) / capacity))
+        debug(Debug.REPORT, "  Lower bound on wall time: {:.2f}s (longest test: {:.2f}s, {}; total work / workers: {:.2f}s)".format(
+            max(longest.end - longest.start, busy / njobs), longest.end - longest.start, timeline_name(longest), busy / njobs))
+        for idx, slot in enumerate(slots):
+            slot_busy = sum(t.end - t.start for t in slot)
+            debug(Debug.INFO, "  Worker {:2}: {:4} test(s), busy {:7.2f}s ({:5.1%}), idle tail {:7.2f}s".format(
+                idx, len(slot), slot_busy, slot_busy / wall, end - slot[-1].end))
+
+        last = max(slots, key=lambda slot: slot[-1].end)
+        critical = last[-top:]
+        debug(Debug.REPORT, "  Critical path: worker {} ran {} test(s) in {:.2f}s{}:".format(
+            slots.index(last), len(last), sum(t.end - t.start for t in last),
+            "; the last {}".format(len(critical)) if len(critical) < len(last) else ""))
+        for t in critical:
+            debug(Debug.REPORT, "    {:7.2f}s .. {:7.2f}s  {}".format(t.start - start, t.end - start, timeline_name(t)))
+        stragglers = sorted((t for t in runs if t.end > drained), key=operator.attrgetter("end"), reverse=True)[:top]
+        if stragglers:
+            debug(Debug.REPORT, "  Running after the last test started:")
+            for t in stragglers:
+                debug(Debug.REPORT, "    {:7.2f}s .. {:7.2f}s  {}".format(t.start - start, t.end - start, timeline_name(t)))
+
+        events.append({"ph": "M", "name": "process_name", "pid": pid, "args": {"name": label}})
+        for idx, slot in enumerate(slots):
+            events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": idx, "args": {"name": "worker {}".format(idx)}})
+            for t in slot:
+                events.append({"ph": "X", "name": timeline_name(t), "cat": t.status.name, "pid": pid, "tid": idx,
+                               "ts": (t.start - start) * 1e6, "dur": (t.end - t.start) * 1e6,
+                               "args": {"status": t.status.name, "attempt": t.attempts, "source": t.source_path}})
+        events.append({"ph": "i", "s": "p", "name": "last test started", "pid": pid, "tid": 0, "ts": (drained - start) * 1e6})
+
+    with open("timeline.json", mode='w') as writer:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, writer)
+    debug(Debug.REPORT, "Timeline written to timeline.json")
+
 def main():
     global VERBOSITY
+    global PARALLEL_RUN_LINES
     parser = setup_parser()
     args = parser.parse_args()
     VERBOSITY = args.verbosity
+    PARALLEL_RUN_LINES = not args.serial_run_lines
 
     if os.name != 'nt' and os.environ.get("TERM") == "cygwin":
         debug(Debug.WARNING, "If you run into issues, try using Windows' Python instead of Cygwin's")
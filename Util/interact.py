@@ -11,9 +11,15 @@ import subprocess
 import json
 import os
 import base64
+import codecs
+import hashlib
+import asyncio
+from collections import defaultdict
 import prompt_toolkit as pt # Install via:  pip3 install prompt_toolkit
+from prompt_toolkit.patch_stdout import patch_stdout
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.validation import Validator
+from proctree import process_tree_rss
 
 # From http://www.lihaoyi.com/post/BuildyourownCommandLinewithANSIescapecodes.html#colors
 def color(s, color):
@@ -47,8 +53,65 @@ class Task:
                 "sourceIsFile" : self.sourceIsFile,
                 "source" :       self.file_name}
 
+class Timing:
+    """When a request was first sent to the server, when the first line was
+    shown to the user, and when the server finished.  A request that is retried
+    after a crash keeps its original start, so it is timed as the user saw it."""
+    def __init__(self):
+        self.start = None
+        self.first_diagnostic = None
+        self.end = None
+
+    def summary(self):
+        first = "no diagnostics" if self.first_diagnostic is None \
+                else "first diagnostic after %.2fs" % (self.first_diagnostic - self.start)
+        return "%s, done after %.2fs" % (first, self.end - self.start)
+
+def kill(pipe):
+    try:
+        pipe.kill()
+    except ProcessLookupError:
+        pass  # Already gone
+
+def resume_stream(streamed, on_line):
+    """Wrap on_line for a retried request: the lines that the failed attempt
+    already passed to on_line are skipped, as long as the retry repeats them."""
+    skipped = 0
+    def resume(line):
+        nonlocal skipped
+        if skipped < len(streamed) and streamed[skipped] == line:
+            skipped += 1
+            return
+        skipped = len(streamed)
+        on_line(line)
+    return resume
+
+class Watchdog:
+    """Limits after which a DafnyServer process is replaced by a fresh one, and
+    whether the replacement is warmed up before it takes over."""
+    def __init__(self, max_memory_mb=None, max_requests=None, prewarm=False):
+        self.max_memory = None if max_memory_mb is None else max_memory_mb * 1e6
+        self.max_requests = max_requests
+        self.prewarm = prewarm
+
+    def reason_to_recycle(self, server):
+        if self.max_requests is not None and server.request_count >= self.max_requests:
+            return "it has answered %d requests" % server.request_count
+        if self.max_memory is not None:
+            rss = process_tree_rss(server.pipe.pid)
+            if rss is not None and rss > self.max_memory:
+                return "it is using %.0fMB" % (rss / 1e6)
+        return None
+
 class DafnyServer:
-    def __init__(self, server_path, no_color, dfy_args, dfy_file_name, hide_info):
+    """asyncio client for a DafnyServer process.  Requests are serialized: a
+    request made while another one is in flight waits for its turn.  Cancelling
+    a request that is already being answered replaces the server process, since
+    the protocol has no way to interrupt it.  The process is also replaced when
+    it crashes, and in the background when it exceeds the watchdog's limits."""
+    def __init__(self, server_path, no_color, dfy_args, dfy_file_name, hide_info, symbol_cache_file=None, pool_size=1,
+                 watchdog=None, history_file=None):
+        self.server_path = server_path
         self.no_color = no_color
         self.dfy_args = dfy_args
         self.dfy_file_name = dfy_file_name
@@ -59,25 +122,106 @@ class DafnyServer:
         self.FAILURE = "FAILURE"
         self.SERVER_EOM_TAG = "[[DAFNY-SERVER: EOM]]"
         self.CLIENT_EOM_TAG = "[[DAFNY-CLIENT: EOM]]"
-
+        self.LINE_LIMIT = 1 << 26  # The symbols are returned on a single, potentially very long line
+
+        self.pipe = None
+        self.lock = asyncio.Lock()  # Held for the duration of a request/response exchange
+        self.requests = set()       # Requests submitted from the UI, running or queued
+        self.symbols = SymbolCache(self, symbol_cache_file)
+        self.pool = ServerPool(self, pool_size)
+        self.changes = ChangeTracker()
+        self.history = TimingHistory(history_file)
+        self.watchdog = watchdog or Watchdog()
+        self.request_count = 0          # Requests answered by the current process
+        self.last_symbols_task = None   # Replayed to warm up a replacement process
+        self.recycler = None            # Background replacement of the process, if one is underway
+        self.interrupted = False        # A warm-up was cancelled with its response still unread
+        self.crashes = 0                # Processes that exited or crashed unexpectedly
+
+    def clone(self):
+        return DafnyServer(self.server_path, self.no_color, self.dfy_args, self.dfy_file_name, self.hide_info,
+                           watchdog=self.watchdog)
+
+    async def start(self):
         try:
-            self.pipe = subprocess.Popen(server_path,
-                                         stdin = subprocess.PIPE,
-                                         stdout = subprocess.PIPE,
-                                         stderr = subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            print(f'Error starting the DafnyServer: {e.output}')
+            self.pipe = await asyncio.create_subprocess_exec(self.server_path,
+                                                             stdin = subprocess.PIPE,
+                                                             stdout = subprocess.PIPE,
+                                                             stderr = subprocess.STDOUT,
+                                                             limit = self.LINE_LIMIT)
+        except OSError as e:
+            print(f'Error starting the DafnyServer: {e}')
             exit()
+        self.request_count = 0
+        self.interrupted = False
+
+    async def stop(self, pipe=None):
+        if pipe is None:
+            pipe = self.pipe
+            if self.recycler is not None:
+                self.recycler.cancel()
+        if pipe is None or pipe.returncode is not None:
+            return
+        try:
+            pipe.stdin.write(('quit\n').encode(self.encoding))
+            await pipe.stdin.drain()
+            await asyncio.wait_for(pipe.wait(), 5)
+        except (OSError, asyncio.TimeoutError):
+            pipe.kill()
+            await pipe.wait()
+
+    async def restart(self):
+        if self.pipe is not None and self.pipe.returncode is None:
+            self.pipe.kill()
+            await self.pipe.wait()
+        await self.start()
+        await self.prewarm()
+
+    async def replace(self, reason):
+        """Start a new server process, warm it up and only then stop the old
+        one.  The caller must hold the lock."""
+        print("Restarting the DafnyServer because %s" % reason)
+        old = self.pipe
+        await self.start()
+        try:
+            await self.prewarm()
+        except asyncio.CancelledError:
+            kill(old)
+            raise
+        await self.stop(old)
 
+    async def recycle(self, reason):
+        try:
+            async with self.lock:
+                await self.replace(reason)
+        finally:
+            self.recycler = None
+
+    async def prewarm(self):
+        """Replay a version query and the last symbols query, if the watchdog
+        asks for it, so that the next real request doesn't pay for the
+        server's start-up."""
+        if not self.watchdog.prewarm:
+            return
+        try:
+            for verb, task in [('version', None), ('symbols', self.last_symbols_task)]:
+                if verb == 'version' or task is not None:
+                    self.write_query(verb, task)
+                    await self.pipe.stdin.drain()
+                    await self.recv_response()
+        except OSError:
+            pass  # The next request will find out that the server is gone
+        except asyncio.CancelledError:
+            # The rest of the response would be read as the answer to the next
+            # request; that request gets a new server instead
+            self.interrupted = True
+            kill(self.pipe)
+            raise
+        self.request_count = 0
 
     def write(self, a_string):
         self.pipe.stdin.write((a_string + '\n').encode(self.encoding))
 
-    def send_version_query(self):
-        self.write('version')
-        self.write(self.CLIENT_EOM_TAG)
-        self.pipe.stdin.flush()
-
     def write_verification_task(self, task):
         query = task.to_dict()
         #print(query)
@@ -87,24 +231,23 @@ class DafnyServer:
         self.pipe.stdin.write(b64)
         self.write('')                     # Add a newline
 
-    def send_symbol_query(self, task):
-        self.write('symbols')
-        self.write_verification_task(task)
+    def write_query(self, verb, task):
+        self.write(verb)
+        if task is not None:
+            self.write_verification_task(task)
         self.write(self.CLIENT_EOM_TAG)
-        self.pipe.stdin.flush()
 
-    def send_verification_query(self, task):
-        self.write('verify')
-        self.write_verification_task(task)
-        self.write(self.CLIENT_EOM_TAG)
-        self.pipe.stdin.flush()
-
-    def recv_response(self, add_color=False):
-        response = ""
+    async def recv_response(self, add_color=False, on_line=None, timing=None):
+        """Read a response up to the server's EOM tag.  Each line that is kept
+        is passed to on_line as soon as it is read."""
+        response = []
         while True:
-            line = self.pipe.stdout.readline().decode(self.encoding)
+            line = (await self.pipe.stdout.readline()).decode(self.encoding)
 
-            if line.startswith("[%s] %s" % (self.SUCCESS, self.SERVER_EOM_TAG)):
+            if line == "":
+                print("WARNING: Server exited unexpectedly")
+                break
+            elif line.startswith("[%s] %s" % (self.SUCCESS, self.SERVER_EOM_TAG)):
                 #print("Ended in success")
                 break
             elif line.startswith("[%s] %s" % (self.FAILURE, self.SERVER_EOM_TAG)):
@@ -121,19 +264,72 @@ class DafnyServer:
                     if "verified" in line:
                         line = color(line, "green")
 
-                response = response + line
+                response.append(line)
+                if timing is not None and timing.first_diagnostic is None:
+                    timing.first_diagnostic = time.time()
+                if on_line is not None:
+                    on_line(line)
+        if timing is not None:
+            timing.end = time.time()
         #print(response)
+        return "".join(response)
+
+    async def exchange(self, verb, task, add_color, on_line, timing):
+        """Send one request and read the response.  Returns None if the server
+        died before answering completely."""
+        if timing is not None and timing.start is None:
+            timing.start = time.time()
+        try:
+            self.write_query(verb, task)
+            await self.pipe.stdin.drain()
+        except OSError:
+            return None
+        response = await self.recv_response(add_color, on_line, timing)
+        return None if self.pipe.stdout.at_eof() else response
+
+    async def query(self, verb, task, add_color=False, on_line=None, timing=None):
+        async with self.lock:
+            try:
+                if self.interrupted:
+                    await self.replace("its warm-up was interrupted")
+                elif self.pipe.returncode is not None:
+                    self.crashes += 1
+                    await self.replace("it exited with code %d" % self.pipe.returncode)
+                streamed = []
+                def stream(line):
+                    streamed.append(line)
+                    on_line(line)
+                response = await self.exchange(verb, task, add_color, on_line and stream, timing)
+                if response is None:
+                    # Retry once on a fresh server; a second crash is most likely caused by the request itself
+                    self.crashes += 1
+                    await self.replace("it crashed")
+                    response = await self.exchange(verb, task, add_color, on_line and resume_stream(streamed, on_line), timing) or ""
+            except asyncio.CancelledError:
+                # The server is still working on this request; replace it
+                await self.restart()
+                raise
+            self.request_count += 1
+            if verb == 'symbols':
+                self.last_symbols_task = task
+        if self.recycler is None:
+            reason = self.watchdog.reason_to_recycle(self)
+            if reason is not None:
+                self.recycler = asyncio.ensure_future(self.recycle(reason))
         return response
 
     def parse_symbols(self, response):
-        match = re.search("SYMBOLS_START (.*) SYMBOLS_END", response)
-        if match:
-            symbols = json.loads(match.group(1))
+        """Return the symbols in a response, or None if there aren't any (for
+        instance because the server crashed)."""
+        start = response.find("SYMBOLS_START ")
+        end = response.rfind(" SYMBOLS_END")
+        if start >= 0 and end > start:
+            symbols = json.loads(response[start + len("SYMBOLS_START "):end])
             #print(symbols)
             return symbols
         else:
             print("Didn't find expected symbols in the server's response")
-            return []
+            return None
 
     def find_functions_methods(self, symbols):
         names = []
@@ -144,21 +340,271 @@ class DafnyServer:
                     names.append(name)
         return names
 
-    def get_version(self):
-        self.send_version_query()
-        response = self.recv_response()
-        return response
+    async def get_version(self):
+        return await self.query('version', None)
+
+    async def get_symbols(self, task):
+        return self.parse_symbols(await self.query('symbols', task)) or []
+
+    async def get_functions_methods(self, task):
+        return self.find_functions_methods(await self.get_symbols(task))
+
+    async def do_verification(self, task, on_line=None, timing=None):
+        return await self.query('verify', task, not self.no_color, on_line, timing)
+
+    def submit(self, coroutine):
+        """Run a request in the background, after the ones already submitted."""
+        if self.requests:
+            print("Queued behind %d running or pending request(s)" % len(self.requests))
+        request = asyncio.ensure_future(coroutine)
+        self.requests.add(request)
+        request.add_done_callback(self.requests.discard)
+        return request
+
+    def cancel(self):
+        """Cancel all running and queued requests.  Returns how many there were."""
+        requests = list(self.requests)
+        for request in requests:
+            request.cancel()
+        return len(requests)
+
+class ServerPool:
+    """A set of DafnyServer processes, the first of which is the main one, used
+    to verify several members of the file at once.  The extra servers are
+    started the first time the pool is used."""
+    def __init__(self, server, size):
+        self.size = max(1, size)
+        self.servers = [server]
+
+    async def start(self):
+        extra = [self.servers[0].clone() for _ in range(self.size - len(self.servers))]
+        await asyncio.gather(*(server.start() for server in extra))
+        self.servers.extend(extra)
+
+    async def stop(self):
+        await asyncio.gather(*(server.stop() for server in self.servers[1:]))
+
+    async def verify_all(self, tasks, callback, on_line=None):
+        """Verify (label, task) pairs on the pool's servers, calling
+        on_line(label, line) for each line of output as it arrives and
+        callback(label, response, timing) as each task completes."""
+        await self.start()
+        queue = asyncio.Queue()
+        for item in tasks:
+            queue.put_nowait(item)
+
+        async def worker(server):
+            while not queue.empty():
+                label, task = queue.get_nowait()
+                timing = Timing()
+                stream = None if on_line is None else (lambda line, label=label: on_line(label, line))
+                response = await server.do_verification(task, stream, timing)
+                callback(label, response, timing)
+
+        await asyncio.gather(*(worker(server) for server in self.servers))
+
+class ChangeTracker:
+    """Remembers a hash of the source text of each method and function (found
+    using the positions DafnyServer reports with the symbols), along with the
+    result of its last successful verification.  Members whose hash is
+    unchanged don't need to be verified again.  A member's hash covers the text
+    of the members it mentions, directly or not, since their bodies and
+    contracts are part of its verification conditions.  All members are
+    considered changed when the text outside of them, or the Dafny arguments,
+    change."""
+    IDENTIFIER = re.compile(r"[\w'?]+")
+    def __init__(self):
+        self.results = {}    # name -> (hash, outcome)
+        self.context = None  # Hash of everything but the members' text
 
-    def get_functions_methods(self, task):
-        self.send_symbol_query(task)
-        response = self.recv_response()
-        symbols = self.parse_symbols(response)
-        return self.find_functions_methods(symbols)
+    @staticmethod
+    def sha256(data):
+        return hashlib.sha256(data).hexdigest()
 
-    def do_verification(self, task):
-        self.send_verification_query(task)
-        response = self.recv_response(add_color=not self.no_color)
-        return response
+    @staticmethod
+    def member_hashes(symbols, text, args):
+        """Return ({name: hash of the name's members' text}, hash of the rest).
+        `text` is the file's bytes: the positions are byte offsets."""
+        ranges = defaultdict(list)
+        for sym in symbols:
+            if sym['SymbolType'] in ('Method', 'Function') and sym['Name'] != '_default' \
+               and sym.get('Position') is not None and sym.get('EndPosition') is not None:
+                ranges[sym['Name']].append((sym['Position'], sym['EndPosition'] + 1))
+        texts = {name: b''.join(text[start:end] for start, end in sorted(spans)) for name, spans in ranges.items()}
+        own = {name: ChangeTracker.sha256(member) for name, member in texts.items()}
+        mentions = {name: set(ChangeTracker.IDENTIFIER.findall(member.decode('utf-8', 'replace'))) & set(texts)
+                    for name, member in texts.items()}
+
+        hashes = {}
+        for name in texts:
+            reachable, pending = {name}, [name]
+            while pending:
+                for other in mentions[pending.pop()] - reachable:
+                    reachable.add(other)
+                    pending.append(other)
+            hashes[name] = ChangeTracker.sha256('\0'.join(other + ':' + own[other] for other in sorted(reachable)).encode('utf-8'))
+
+        context, pos = [json.dumps(args).encode('utf-8')], 0
+        for start, end in sorted(span for spans in ranges.values() for span in spans):
+            if start > pos:
+                context.append(text[pos:start])
+            pos = max(pos, end)
+        context.append(text[pos:])
+        return hashes, ChangeTracker.sha256(b'\0'.join(context))
+
+    async def snapshot(self, server):
+        with open(server.dfy_file_name, 'rb') as reader:
+            text = reader.read()  # The parser scans the UTF-8 bytes, so positions are byte offsets
+        if text.startswith(codecs.BOM_UTF8):
+            text = text[len(codecs.BOM_UTF8):]  # The parser's StreamReader drops it
+        symbols = await server.symbols.get_symbols()
+        return self.member_hashes(symbols, text, server.dfy_args)
+
+    def changed(self, names, snapshot):
+        hashes, context = snapshot
+        if context != self.context:
+            return list(names)
+        return [name for name in names
+                if name not in self.results or self.results[name][0] != hashes.get(name)]
+
+    def record(self, name, snapshot, response):
+        hashes, context = snapshot
+        if context != self.context:
+            self.results, self.context = {}, context
+        if verification_succeeded(response) and name in hashes:
+            self.results[name] = (hashes[name], verification_outcome(response))
+        else:
+            self.results.pop(name, None)
+
+class TimingHistory:
+    """Wall time of past verifications of each method and function, per Dafny
+    file, persisted as JSON across sessions.  Whole-file verifications are
+    recorded under WHOLE_FILE."""
+    WHOLE_FILE = "(entire file)"
+    MAX_RUNS = 50  # Per member
+
+    def __init__(self, history_file=None):
+        self.history_file = history_file
+        self.runs = {}  # file -> name -> [[time, duration, outcome], ...]
+        if history_file is not None and os.path.isfile(history_file):
+            try:
+                with open(history_file, 'r') as reader:
+                    self.runs = json.load(reader)
+            except (OSError, ValueError) as e:
+                print("Ignoring unreadable verification history %s: %s" % (history_file, e))
+
+    def record(self, file_name, name, duration, response):
+        runs = self.runs.setdefault(os.path.abspath(file_name), {}).setdefault(name, [])
+        runs.append([time.time(), duration, verification_outcome(response)])
+        del runs[:-self.MAX_RUNS]
+        self.save()
+
+    def save(self):
+        if self.history_file is None:
+            return
+        tmp = self.history_file + '.tmp'
+        with open(tmp, 'w') as writer:
+            json.dump(self.runs, writer)
+        os.replace(tmp, self.history_file)
+
+    @staticmethod
+    def trend(durations, recent=3):
+        """Change of the mean of the last `recent` runs relative to the mean of
+        the runs before them, or None if there aren't enough runs."""
+        if len(durations) <= recent:
+            return None
+        before = durations[-3 * recent:-recent]
+        before = sum(before) / len(before)
+        after = sum(durations[-recent:]) / recent
+        return None if before == 0 else (after - before) / before
+
+    def slowest(self, file_name, count):
+        """Return (name, runs) for the `count` members of the file whose latest
+        verification took longest."""
+        members = self.runs.get(os.path.abspath(file_name), {})
+        ranked = sorted(members.items(), key=lambda item: item[1][-1][1], reverse=True)
+        return ranked[:count]
+
+class SymbolCache:
+    """Remembers the symbols DafnyServer reports for the Dafny file, keyed by a
+    hash of the file's contents and of the Dafny arguments.  The hash is only
+    recomputed when the file's mtime or size changes.  Entries can be persisted
+    to a JSON file, and a background task can refresh them when the file
+    changes.  Only the most recently used entries are kept."""
+    MAX_ENTRIES = 100
+
+    def __init__(self, server, cache_file=None):
+        self.server = server
+        self.cache_file = cache_file
+        self.fetch_lock = asyncio.Lock()  # Avoids asking the server twice for the same symbols
+        self.entries = {}
+        self.stamp = None
+        self.key = None
+        self.watcher = None
+        if cache_file is not None and os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'r') as reader:
+                    self.entries = json.load(reader)
+                self.trim()
+            except (OSError, ValueError) as e:
+                print("Ignoring unreadable symbol cache %s: %s" % (cache_file, e))
+
+    def hash_file(self):
+        digest = hashlib.sha256()
+        with open(self.server.dfy_file_name, 'rb') as reader:
+            digest.update(reader.read())
+        digest.update(json.dumps(self.server.dfy_args).encode('utf-8'))
+        return digest.hexdigest()
+
+    async def file_key(self):
+        st = os.stat(self.server.dfy_file_name)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp != self.stamp:
+            key = await asyncio.get_event_loop().run_in_executor(None, self.hash_file)
+            self.stamp, self.key = stamp, key
+        return self.key
+
+    async def get_symbols(self):
+        key = await self.file_key()
+        if key not in self.entries:
+            async with self.fetch_lock:
+                if key not in self.entries:
+                    task = Task(self.server.dfy_args, self.server.dfy_file_name, True, self.server.dfy_file_name)
+                    symbols = self.server.parse_symbols(await self.server.query('symbols', task))
+                    if symbols is None:
+                        return []  # Not cached, so that the next call asks again
+                    self.entries[key] = symbols
+                    self.trim()
+                    self.save()
+        symbols = self.entries.pop(key)
+        self.entries[key] = symbols  # Most recently used last
+        return symbols
+
+    def trim(self):
+        for key in list(self.entries)[:-self.MAX_ENTRIES]:
+            del self.entries[key]
+
+    async def get_functions_methods(self):
+        return self.server.find_functions_methods(await self.get_symbols())
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        tmp = self.cache_file + '.tmp'
+        with open(tmp, 'w') as writer:
+            json.dump(self.entries, writer)
+        os.replace(tmp, self.cache_file)
+
+    def start_watcher(self, interval=1.0):
+        self.watcher = asyncio.ensure_future(self.watch(interval))
+
+    async def watch(self, interval):
+        while True:
+            try:
+                await self.get_symbols()
+            except (OSError, ValueError):
+                pass # The file may be in the middle of being saved; try again later
+            await asyncio.sleep(interval)
 
 def parse_args(args):
     a = args.split(' ')
@@ -188,41 +634,123 @@ def is_number(text):
 def in_bounds(n, lbound=None, ubound=None):
     return (lbound is None or lbound <= int(n)) and (ubound is None or int(n) < ubound)
 
-def do_file(session, server):
+async def print_verification(server, task, name):
+    timing = Timing()
+    try:
+        response = await server.do_verification(task, lambda line: print(line, end='', flush=True), timing)
+        print("(%s)\n" % timing.summary())
+        server.history.record(server.dfy_file_name, name, timing.end - timing.start, response)
+    except asyncio.CancelledError:
+        print("Verification cancelled")
+
+async def do_file(session, server):
     task = Task(server.dfy_args, server.dfy_file_name, True, server.dfy_file_name)
-    print(server.do_verification(task))
+    server.submit(print_verification(server, task, TimingHistory.WHOLE_FILE))
 
-def verify_function_method(server, name):
+def function_method_task(server, name):
     args = server.dfy_args + ["/proc:*%s*" % name.replace('_', "__")]
-    task = Task(args, server.dfy_file_name, True, server.dfy_file_name)
-    print(server.do_verification(task))
+    return Task(args, server.dfy_file_name, True, server.dfy_file_name)
+
+def verify_function_method(server, name):
+    server.submit(print_verification(server, function_method_task(server, name), name))
+
+def verification_outcome(response):
+    match = re.search(r"finished with (\d+) verified, (\d+) error", response)
+    if match is None:
+        return "no result"
+    return "%s verified, %s error(s)" % match.groups()
+
+def verification_succeeded(response):
+    match = re.search(r"finished with (\d+) verified, (\d+) error", response)
+    return match is not None and int(match.group(2)) == 0 \
+           and not re.search(r"time out|out of resource|inconclusive", response)
+
+async def verify_all_in_parallel(server, names, snapshot=None):
+    results = []
+    def show(name, line):
+        print("[%s] %s" % (name, line), end='', flush=True)
+
+    def report(name, response, timing):
+        if snapshot is not None:
+            server.changes.record(name, snapshot, response)
+        duration = timing.end - timing.start
+        server.history.record(server.dfy_file_name, name, duration, response)
+        results.append((duration, name, verification_outcome(response)))
+        print("Finished %s (%d/%d; %s)" % (name, len(results), len(names), timing.summary()))
+
+    start = time.time()
+    try:
+        await server.pool.verify_all([(name, function_method_task(server, name)) for name in names], report, show)
+    except asyncio.CancelledError:
+        print("Verification cancelled")
+        return
+
+    print("\nVerified %d member(s) in %.2fs on %d server(s); slowest first:" % (len(names), time.time() - start, len(server.pool.servers)))
+    for duration, name, outcome in sorted(results, reverse=True):
+        print("\t%8.2fs  %s: %s" % (duration, name, outcome))
 
 prev_function_method = None
 
-def do_function_method(session, server):
+async def do_function_method(session, server):
     global prev_function_method
-    task = Task(server.dfy_args, server.dfy_file_name, True, server.dfy_file_name)
-    names = server.get_functions_methods(task)
+    names = await server.symbols.get_functions_methods()
     print("\nFound:")
     for name in names:
         print("\t" + name)
     #names = sorted(names)
     name_completer = pt.completion.WordCompleter(names, ignore_case=True)
-    name = session.prompt("Enter a name (tab complete at any time): ",
-                          completer=name_completer,
-                          complete_while_typing=True,
-                          validate_while_typing=False,
-                          validator=Validators.set_validator(set(names)))
+    name = await session.prompt_async("Enter a name (tab complete at any time): ",
+                                      completer=name_completer,
+                                      complete_while_typing=True,
+                                      validate_while_typing=False,
+                                      validator=Validators.set_validator(set(names)))
     prev_function_method = name
     verify_function_method(server, name)
 
-def do_prev_function_method(session, server):
+async def do_prev_function_method(session, server):
     global prev_function_method
     if not prev_function_method is None:
         verify_function_method(server, prev_function_method)
     else:
         print("No previous function/method found.  Please choose one.")
-        do_function_method(session, server)
+        await do_function_method(session, server)
+
+async def do_all_in_parallel(session, server):
+    names = await server.symbols.get_functions_methods()
+    snapshot = await server.changes.snapshot(server)
+    server.submit(verify_all_in_parallel(server, names, snapshot))
+
+async def do_changed(session, server):
+    names = await server.symbols.get_functions_methods()
+    snapshot = await server.changes.snapshot(server)
+    changed = server.changes.changed(names, snapshot)
+    for name in names:
+        if name not in changed:
+            print("\t[unchanged] %s: %s" % (name, server.changes.results[name][1]))
+    if changed:
+        server.submit(verify_all_in_parallel(server, changed, snapshot))
+    else:
+        print("Nothing changed since the last successful verification")
+
+async def do_slowest(session, server, count=20):
+    slowest = server.history.slowest(server.dfy_file_name, count)
+    if not slowest:
+        print("No verification times recorded for %s yet" % server.dfy_file_name)
+        return
+    print("\nSlowest Methods/Functions by their last verification time:")
+    print("\t%9s %9s %9s %7s  %s" % ("last", "best", "worst", "trend", "name (recent times)"))
+    for name, runs in slowest:
+        durations = [duration for _, duration, _ in runs]
+        trend = TimingHistory.trend(durations)
+        recent = " ".join("%.2f" % duration for duration in durations[-5:])
+        print("\t%8.2fs %8.2fs %8.2fs %7s  %s (%s) %s" % (
+            durations[-1], min(durations), max(durations),
+            "" if trend is None else "%+.0f%%" % (trend * 100), name, recent, runs[-1][2]))
+
+async def do_cancel(session, server):
+    count = server.cancel()
+    if count == 0:
+        print("Nothing to cancel")
 
 class Validators:
     @staticmethod
@@ -246,7 +774,7 @@ class Validators:
 
 prev_option = None
 
-def dispatcher(session, options, data):
+async def dispatcher(session, options, data):
     global prev_option
 
     print("Please choose from the following options: ")
@@ -255,9 +783,9 @@ def dispatcher(session, options, data):
 
     default = prev_option
     prompt = 'Option: ' if prev_option is None else 'Option (%s): ' % prev_option
-    selection = session.prompt(prompt,
-                               validate_while_typing=False,
-                               validator=Validators.number_validator(0, len(options)))
+    selection = await session.prompt_async(prompt,
+                                           validate_while_typing=False,
+                                           validator=Validators.number_validator(0, len(options)))
     if selection == "":
         if not prev_option is None:
             selection = prev_option
@@ -268,21 +796,30 @@ def dispatcher(session, options, data):
         selection = int(selection)
     prev_option = selection
     _, func = options[selection]
-    func(session, data)
+    await func(session, data)
 
-def event_loop(server):
+async def event_loop(server):
     our_history = pt.history.FileHistory(".cmd_history")
     session = pt.PromptSession(history=our_history, key_bindings=bindings)
     actions = [('Verify the entire file', do_file),
                ('Verify a specific Method/Function',do_function_method),
-               ('Verify the previous Method/Function',do_prev_function_method)]
-    while True:
-        try:
-            dispatcher(session, actions, server)
-        except EOFError:
-            break
-        else:
-            pass
+               ('Verify the previous Method/Function',do_prev_function_method),
+               ('Verify all Methods/Functions in parallel', do_all_in_parallel),
+               ('Verify the Methods/Functions changed since they last verified', do_changed),
+               ('Show the slowest Methods/Functions and their trends', do_slowest),
+               ('Cancel running verifications', do_cancel)]
+    with patch_stdout():
+        while True:
+            try:
+                await dispatcher(session, actions, server)
+            except KeyboardInterrupt:
+                # Ctrl-C cancels running verifications, or exits if there are none
+                if server.cancel() == 0:
+                    break
+            except EOFError:
+                break
+            else:
+                pass
 
 #############################################
 #
@@ -307,6 +844,18 @@ def main():
                         help="Don't add color to verification results")
     parser.add_argument('--show-tooltips', action='store_true', default=False, required=False,
                         help="Show all of the tooltips that Dafny returns")
+    parser.add_argument('-j', '--pool-size', action='store', type=int, default=min(4, os.cpu_count() or 1), required=False,
+                        help="Number of DafnyServer processes used to verify all methods/functions in parallel")
+    parser.add_argument('--symbol-cache', action='store', default=None, required=False,
+                        help="File in which to keep the symbols of previously seen versions of the Dafny file across sessions (e.g. .symbol_cache)")
+    parser.add_argument('--max-server-memory', action='store', type=float, default=None, required=False,
+                        help="Restart a DafnyServer once its resident memory exceeds this many MB")
+    parser.add_argument('--max-server-requests', action='store', type=int, default=None, required=False,
+                        help="Restart a DafnyServer once it has answered this many requests")
+    parser.add_argument('--prewarm', action='store_true', default=False, required=False,
+                        help="Replay the version and last symbols queries on a restarted DafnyServer before using it")
+    parser.add_argument('--history', action='store', default='.verification_history', required=False,
+                        help="File in which to keep the verification times of each Method/Function.  Defaults to %(default)s")
 
     args = parser.parse_args()
 
@@ -316,9 +865,21 @@ def main():
     elif os.path.isfile(args.arg_file):
         dfy_args = read_arg_file(args.arg_file)
 
-    server = DafnyServer(args.server, args.no_color, dfy_args, args.dfy, not args.show_tooltips)
-
-    event_loop(server)
+    asyncio.run(run_session(args, dfy_args))
+
+async def run_session(args, dfy_args):
+    watchdog = Watchdog(args.max_server_memory, args.max_server_requests, args.prewarm)
+    server = DafnyServer(args.server, args.no_color, dfy_args, args.dfy, not args.show_tooltips,
+                         args.symbol_cache, args.pool_size, watchdog, args.history)
+    await server.start()
+    server.symbols.start_watcher()
+    try:
+        await event_loop(server)
+    finally:
+        server.symbols.watcher.cancel()
+        server.cancel()
+        await server.pool.stop()
+        await server.stop()
 
 
 if (__name__=="__main__"):
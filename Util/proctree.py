@@ -0,0 +1,25 @@
+# Memory measurements shared by interact.py, server_benchmark.py and
+# Test/benchmarkRunTests.py.  Standard library only, so that the benchmarks
+# don't need interact.py's dependencies.
+
+import os
+
+def process_tree_rss(pid):
+    """Resident memory, in bytes, of process `pid` and its descendants, or None
+    where /proc isn't available.  The server is often started through a
+    wrapper script, so the children have to be counted too."""
+    total, pending, seen = 0, [pid], False
+    while pending:
+        pid = pending.pop()
+        try:
+            with open('/proc/%d/status' % pid) as reader:
+                for line in reader:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        seen = True
+            for tid in os.listdir('/proc/%d/task' % pid):
+                with open('/proc/%d/task/%s/children' % (pid, tid)) as reader:
+                    pending.extend(int(child) for child in reader.read().split())
+        except (OSError, ValueError):
+            continue
+    return total if seen else None
@@ -0,0 +1,281 @@
+#!/usr/local/bin/python3
+
+# Benchmark the latency of the DafnyServer protocol, as seen by editor integrations.
+#
+# Requests are taken from the .transcript files in Test/server and sent through
+# the same client that interact.py uses.  The script measures how long a fresh
+# server takes to answer its first request, the round-trip latency and
+# throughput of repeated version/symbols/verify requests to a warm server, and
+# how the server's memory grows over the run.  Results are saved as JSON so that
+# two builds can be compared with --compare.
+
+import argparse
+import asyncio
+import base64
+import binascii
+import datetime
+import glob
+import json
+import os
+import platform
+import time
+
+from interact import DafnyServer, Task
+from proctree import process_tree_rss
+
+VERBS = ['version', 'symbols', 'verify']
+CLIENT_EOM_TAG = "[[DAFNY-CLIENT: EOM]]"
+
+#############################################
+#
+#   Reading requests from transcripts
+#
+#############################################
+
+def read_transcript(file_name):
+    """Return the (verb, task) pairs in a .transcript file.  Requests whose
+    payload isn't a base64-encoded verification task are skipped."""
+    requests = []
+    verb, payload = None, []
+    with open(file_name) as reader:
+        for line in reader:
+            line = line.strip()
+            if verb is None:
+                if line and not line.startswith('#'):
+                    verb, payload = line, []
+            elif line == CLIENT_EOM_TAG:
+                task = decode_task(''.join(payload))
+                if task is not None or verb == 'version':
+                    requests.append((verb, task))
+                verb = None
+            else:
+                payload.append(line)
+    return requests
+
+def decode_task(payload):
+    try:
+        query = json.loads(base64.b64decode(payload, validate=True))
+        return Task(query["args"], query["filename"], query["sourceIsFile"], query["source"])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        return None
+
+def read_tasks(transcripts):
+    """Collect the verification tasks found in the transcripts.  The same tasks
+    are used for the symbols and verify benchmarks."""
+    tasks = []
+    for file_name in transcripts:
+        tasks.extend(task for verb, task in read_transcript(file_name) if verb == 'verify')
+    return tasks
+
+#############################################
+#
+#   Measurements
+#
+#############################################
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list."""
+    values = sorted(values)
+    rank = max(1, int(round(p / 100.0 * len(values) + 0.5 - 1e-9)))
+    return values[min(rank, len(values)) - 1]
+
+def summarize(latencies):
+    if not latencies:
+        return None
+    return {"count" : len(latencies),
+            "min"   : min(latencies),
+            "mean"  : sum(latencies) / len(latencies),
+            "p50"   : percentile(latencies, 50),
+            "p90"   : percentile(latencies, 90),
+            "p99"   : percentile(latencies, 99),
+            "max"   : max(latencies)}
+
+def slope(samples):
+    """Least-squares growth per request of (request number, bytes) samples."""
+    if len(samples) < 2:
+        return None
+    n = len(samples)
+    mean_x = sum(x for x, _ in samples) / n
+    mean_y = sum(y for _, y in samples) / n
+    var = sum((x - mean_x) ** 2 for x, _ in samples)
+    if var == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in samples) / var
+
+def new_server(args):
+    return DafnyServer(args.server, True, [], None, False)
+
+async def request(server, verb, task):
+    start = time.perf_counter()
+    await server.query(verb, task)
+    return time.perf_counter() - start
+
+async def cold_start(args):
+    """Time from launching a server until it has answered `version`."""
+    latencies = []
+    for _ in range(args.cold_runs):
+        server = new_server(args)
+        start = time.perf_counter()
+        await server.start()
+        await server.query('version', None)
+        latencies.append(time.perf_counter() - start)
+        await server.stop()
+    return latencies
+
+async def warm(args, tasks):
+    """Send each verb `--repeat` times to one long-lived server, cycling
+    through the transcript tasks, and sample the server's memory as it goes.
+    The server restarts itself after a crash; the crashes are counted."""
+    server = new_server(args)
+    await server.start()
+    try:
+        version = (await server.get_version()).split('\n')[0].strip()
+        results, memory = {}, []
+        count = 0
+        rss = process_tree_rss(server.pipe.pid)
+        if rss is not None:
+            memory.append((count, rss))
+        for verb in args.verbs:
+            if verb != 'version' and not tasks:
+                print("No verification tasks found; skipping %s" % verb)
+                continue
+            latencies = []
+            # Untimed warm-up, so that JIT compilation doesn't count against the first verb
+            await request(server, verb, tasks[0] if verb != 'version' else None)
+            start = time.perf_counter()
+            for i in range(args.repeat):
+                task = None if verb == 'version' else tasks[i % len(tasks)]
+                latencies.append(await request(server, verb, task))
+                count += 1
+                if args.memory_every and count % args.memory_every == 0:
+                    rss = process_tree_rss(server.pipe.pid)
+                    if rss is not None:
+                        memory.append((count, rss))
+            elapsed = time.perf_counter() - start
+            results[verb] = summarize(latencies)
+            results[verb]["throughput"] = len(latencies) / elapsed if elapsed > 0 else None
+        return version, results, memory, server.crashes
+    finally:
+        await server.stop()
+
+async def run_benchmark(args):
+    tasks = read_tasks(args.transcripts)
+    print("Benchmarking %s with %d task(s) from %d transcript(s)" % (args.server, len(tasks), len(args.transcripts)))
+    cold = await cold_start(args) if args.cold_runs else []
+    version, warm_results, memory, crashes = await warm(args, tasks)
+    return {"server"      : args.server,
+            "version"     : version,
+            "label"       : args.label,
+            "date"        : datetime.datetime.now().isoformat(),
+            "host"        : platform.node(),
+            "proc_info"   : platform.processor(),
+            "transcripts" : [os.path.basename(name) for name in args.transcripts],
+            "repeat"      : args.repeat,
+            "cold_start"  : summarize(cold),
+            "warm"        : warm_results,
+            "crashes"     : crashes,
+            "memory"      : {"samples"           : memory,
+                             "start"             : memory[0][1] if memory else None,
+                             "end"               : memory[-1][1] if memory else None,
+                             "peak"              : max(rss for _, rss in memory) if memory else None,
+                             "growth_per_request": slope(memory)}}
+
+#############################################
+#
+#   Reporting
+#
+#############################################
+
+def ms(seconds):
+    return "%8.1fms" % (seconds * 1000)
+
+def mb(size):
+    return "n/a" if size is None else "%.1fMB" % (size / 1e6)
+
+def print_results(results):
+    print("Server version: %s" % results["version"])
+    print("%-12s %8s %10s %10s %10s %10s %10s %8s" % ("", "count", "p50", "p90", "p99", "max", "mean", "req/s"))
+    rows = [("cold start", results["cold_start"])] + list(results["warm"].items())
+    for name, stats in rows:
+        if stats is None:
+            continue
+        throughput = stats.get("throughput")
+        print("%-12s %8d %10s %10s %10s %10s %10s %8s" % (
+            name, stats["count"], ms(stats["p50"]), ms(stats["p90"]), ms(stats["p99"]),
+            ms(stats["max"]), ms(stats["mean"]), "" if throughput is None else "%.1f" % throughput))
+    memory = results["memory"]
+    growth = memory["growth_per_request"]
+    print("Server memory: %s at start, %s at end, %s peak; %s per 100 requests" % (
+        mb(memory["start"]), mb(memory["end"]), mb(memory["peak"]),
+        "n/a" if growth is None else mb(growth * 100)))
+    if results.get("crashes"):
+        print("Server crashes: %d (each followed by a restart and a retry)" % results["crashes"])
+
+def compare(baseline, results):
+    """Print the change of each statistic relative to a previous run."""
+    def change(old, new):
+        if old is None or new is None or old == 0:
+            return "n/a"
+        return "%+.1f%%" % ((new - old) / old * 100)
+
+    print("Compared with %s (%s):" % (baseline.get("label") or baseline["version"], baseline["date"]))
+    rows = [("cold start", baseline["cold_start"], results["cold_start"])]
+    rows += [(verb, baseline["warm"].get(verb), stats) for verb, stats in results["warm"].items()]
+    for name, old, new in rows:
+        if old is None or new is None:
+            continue
+        print("%-12s p50 %s -> %s (%s)   p99 %s -> %s (%s)" % (
+            name, ms(old["p50"]), ms(new["p50"]), change(old["p50"], new["p50"]),
+            ms(old["p99"]), ms(new["p99"]), change(old["p99"], new["p99"])))
+    old, new = baseline["memory"], results["memory"]
+    print("%-12s end %s -> %s (%s)" % ("memory", mb(old["end"]), mb(new["end"]), change(old["end"], new["end"])))
+
+#############################################
+#
+#   Main
+#
+#############################################
+
+def main():
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    default_server_path = './Binaries/dafny-server'
+    default_transcripts = os.path.join(script_dir, '..', 'Test', 'server', '*.transcript')
+    parser = argparse.ArgumentParser(description="Benchmark the latency of the DafnyServer protocol")
+    parser.add_argument('-s', '--server', action='store', default=default_server_path,
+                        help="Path to the DafnyServer.  Defaults to %s" % default_server_path)
+    parser.add_argument('transcripts', nargs='*',
+                        help="Transcript files to take requests from.  Defaults to Test/server/*.transcript")
+    parser.add_argument('-n', '--repeat', action='store', type=int, default=50,
+                        help="Number of warm requests per verb.  Defaults to %(default)s")
+    parser.add_argument('--cold-runs', action='store', type=int, default=5,
+                        help="Number of cold starts to measure.  Defaults to %(default)s")
+    parser.add_argument('--verbs', action='store', nargs='+', choices=VERBS, default=VERBS,
+                        help="Requests to benchmark on the warm server.  Defaults to all of them")
+    parser.add_argument('--memory-every', action='store', type=int, default=5,
+                        help="Sample the server's memory every N warm requests (0 to disable).  Defaults to %(default)s")
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help="JSON file to save the results in.  Defaults to server-benchmark-<date>.json")
+    parser.add_argument('--label', action='store', default=None,
+                        help="Name for this build in the saved results, e.g. a commit hash")
+    parser.add_argument('--compare', action='store', default=None,
+                        help="Saved results of another build to compare with")
+
+    args = parser.parse_args()
+    if not args.transcripts:
+        args.transcripts = sorted(glob.glob(default_transcripts))
+
+    results = asyncio.run(run_benchmark(args))
+    print_results(results)
+
+    output = args.output or "server-benchmark-%s.json" % time.strftime("%Y-%m-%d-%H-%M-%S")
+    with open(output, mode='w') as writer:
+        json.dump(results, writer, indent=2)
+    print("Results saved to %s" % output)
+
+    if args.compare:
+        with open(args.compare) as reader:
+            compare(json.load(reader), results)
+
+
+if (__name__=="__main__"):
+  main()